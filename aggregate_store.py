@@ -0,0 +1,159 @@
+"""Materialized aggregates of the sessions in SQLite, maintained incrementally across data reloads
+
+The store keeps the daily segment aggregates (sessions, page views and seconds per day, country,
+device and OS) and every user's first and last session date. Each site's sheet only grows by
+appending rows, so an update aggregates just the rows of every site past the ones already ingested
+and upserts them: only the days and users those rows touch are written. The ingested rows of each
+site are fingerprinted; if any of them changed, a sheet was edited rather than appended to and the
+store is rebuilt.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+from contextlib import closing
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import instrumented, span
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS daily_segments (
+    date TEXT NOT NULL,
+    country TEXT NOT NULL,
+    device TEXT NOT NULL,
+    os TEXT NOT NULL,
+    sessions INTEGER NOT NULL,
+    page_views NUMERIC NOT NULL,
+    seconds REAL NOT NULL,
+    PRIMARY KEY (date, country, device, os)
+);
+-- user_id has no declared type, so numeric IDs from the sheet keep their type
+CREATE TABLE IF NOT EXISTS users (
+    user_id PRIMARY KEY,
+    first_seen TEXT NOT NULL,
+    last_seen TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS metadata (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# Columns identifying an ingested row when checking that earlier rows are unchanged
+FINGERPRINT_COLUMNS = ["Date", "Clarity user ID", "Country", "Device", "OS", "Page count", "TotalSeconds"]
+
+
+def row_hashes(df):
+    """Hash of every row of the preprocessed sessions over the FINGERPRINT_COLUMNS"""
+    return pd.util.hash_pandas_object(df[FINGERPRINT_COLUMNS], index=False).to_numpy()
+
+
+def rows_fingerprint(hashes):
+    """Fingerprint of a run of row hashes, changed by an edit to any of the rows or their order"""
+    return hashlib.sha1(hashes.tobytes()).hexdigest()
+
+
+class AggregateStore:
+    """Daily segment aggregates and user first/last-seen dates kept in a SQLite file"""
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with closing(self.connect()) as connection:
+            connection.executescript(SCHEMA)
+
+    def connect(self):
+        """A new connection; each operation uses its own so sessions on different threads never share one"""
+        return sqlite3.connect(self.path)
+
+    def metadata(self, connection):
+        return dict(connection.execute("SELECT key, value FROM metadata").fetchall())
+
+    @instrumented("aggregate_store.update")
+    def update(self, df):
+        """Bring the store up to date with the preprocessed sessions, returning the number of rows ingested
+
+        The rows of every site are checked and appended on their own: the sites are concatenated, so
+        rows appended to one site move those of the sites after it.
+        """
+        hashes = row_hashes(df)
+        site_rows = {str(site): positions for site, positions in df.groupby("Site", observed=True).indices.items()}
+        with closing(self.connect()) as connection, connection:
+            # Rows ingested and their fingerprint per site
+            ingested = json.loads(self.metadata(connection).get('sites', '{}'))
+
+            # Appended rows leave every earlier row of their site as it was; hashing them all is cheap next to
+            # aggregating. A site that disappeared takes its rows with it, so the store is rebuilt.
+            appended = bool(ingested) and ingested.keys() <= site_rows.keys() and all(
+                state['rows'] <= len(site_rows[site]) and
+                rows_fingerprint(hashes[site_rows[site][:state['rows']]]) == state['fingerprint']
+                for site, state in ingested.items())
+            if not appended:
+                connection.execute("DELETE FROM daily_segments")
+                connection.execute("DELETE FROM users")
+                connection.execute("DELETE FROM metadata")
+                ingested = {}
+
+            new_positions = [positions[ingested[site]['rows'] if site in ingested else 0:]
+                             for site, positions in site_rows.items()]
+            new_rows = df.iloc[np.sort(np.concatenate(new_positions or [np.empty(0, dtype="int64")]))]
+            if len(new_rows):
+                self._upsert(connection, new_rows)
+                sites = {site: {'rows': len(positions), 'fingerprint': rows_fingerprint(hashes[positions])}
+                         for site, positions in site_rows.items()}
+                connection.execute("INSERT OR REPLACE INTO metadata (key, value) VALUES ('sites', ?)",
+                                   [json.dumps(sites)])
+        return len(new_rows)
+
+    def _upsert(self, connection, rows):
+        """Add the aggregates of new rows to the days and users they touch"""
+        with span("aggregate_store.upsert", rows=len(rows)):
+            dates = rows["Date"].dt.strftime("%Y-%m-%d")
+            segments = rows.groupby([dates, rows["Country"], rows["Device"], rows["OS"]]).agg(
+                sessions=('Page count', 'size'), page_views=('Page count', 'sum'), seconds=('TotalSeconds', 'sum')
+            ).reset_index()
+            connection.executemany("""
+                INSERT INTO daily_segments (date, country, device, os, sessions, page_views, seconds)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (date, country, device, os) DO UPDATE SET
+                    sessions = sessions + excluded.sessions,
+                    page_views = page_views + excluded.page_views,
+                    seconds = seconds + excluded.seconds
+            """, list(zip(*[segments[column].tolist() for column in segments.columns])))
+
+            users = dates.groupby(rows["Clarity user ID"]).agg(['min', 'max'])
+            connection.executemany("""
+                INSERT INTO users (user_id, first_seen, last_seen) VALUES (?, ?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    first_seen = min(first_seen, excluded.first_seen),
+                    last_seen = max(last_seen, excluded.last_seen)
+            """, list(zip(users.index.tolist(), users['min'].tolist(), users['max'].tolist())))
+
+    @instrumented("aggregate_store.segments")
+    def segments(self, start_date=None, end_date=None):
+        """Daily segment aggregates, optionally of a date range, in the format of analytics_core.build_daily_segments"""
+        query = "SELECT date, country, device, os, sessions, page_views, seconds FROM daily_segments"
+        parameters = []
+        if start_date is not None and end_date is not None:
+            query += " WHERE date BETWEEN ? AND ?"
+            parameters = [pd.to_datetime(date).strftime("%Y-%m-%d") for date in (start_date, end_date)]
+        query += " ORDER BY date, country, device, os"
+        with closing(self.connect()) as connection:
+            segments = pd.read_sql_query(query, connection, params=parameters)
+
+        segments.columns = ['Date', 'Country', 'Device', 'OS', 'sessions', 'page_views', 'seconds']
+        segments['Date'] = pd.to_datetime(segments['Date'])
+        return segments
+
+    @instrumented("aggregate_store.first_seen")
+    def first_seen(self):
+        """First session date of every user, indexed by user ID like analytics_core.user_first_seen"""
+        with closing(self.connect()) as connection:
+            users = pd.read_sql_query("SELECT user_id, first_seen FROM users", connection)
+        first_seen = pd.to_datetime(users['first_seen'])
+        first_seen.index = pd.Index(users['user_id'], name="Clarity user ID")
+        return first_seen.rename("Date")
@@ -0,0 +1,963 @@
+"""Analytics computations behind the Gitforce dashboard
+
+Everything here is plain pandas/numpy with no Streamlit dependency, so the same metrics can be
+computed by the dashboard, by the batch report generator or from a profiler.
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from urllib.parse import urlparse
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import instrumented, span
+
+logger = logging.getLogger(__name__)
+
+SHEET_SCOPES = [
+    "https://spreadsheets.google.com/feeds",
+    "https://www.googleapis.com/auth/spreadsheets",
+    "https://www.googleapis.com/auth/drive"
+]
+
+COMPARISON_TYPES = ["Last Trailing Period", "Same Period Last Month", "Same Period Last Year"]
+
+# Clarity exports loaded by default: one site, one workbook, one worksheet
+DEFAULT_SOURCES = [{"site": "Gitforce", "workbook": "Clarity Data", "worksheet": "Downloaded data"}]
+
+
+def load_google_sheets_data(credentials_dict, workbook="Clarity Data", worksheet="Downloaded data"):
+    """Load the raw session rows of one worksheet with a service account"""
+    import gspread
+    from google.oauth2.service_account import Credentials
+
+    with span("fetch_sheet", workbook=workbook, worksheet=worksheet) as fetch:
+        creds = Credentials.from_service_account_info(credentials_dict, scopes=SHEET_SCOPES)
+        client = gspread.authorize(creds)
+
+        data = client.open(workbook).worksheet(worksheet).get_all_records()
+        fetch['rows'] = len(data)
+
+    return pd.DataFrame(data)
+
+
+def load_sources(credentials_dict, sources=DEFAULT_SOURCES):
+    """Load several Clarity exports concurrently and merge them into one frame with a Site column
+
+    Each source is a mapping with site, workbook and worksheet keys. The sources are fetched on a
+    thread each, so the load takes about as long as the slowest one. Returns the merged rows and
+    a warning per source that failed; if every source fails the first error is raised. Without any
+    sources the frame is empty.
+    """
+    if not sources:
+        return pd.DataFrame(), []
+    with ThreadPoolExecutor(max_workers=len(sources)) as pool:
+        futures = [pool.submit(load_google_sheets_data, credentials_dict, source["workbook"], source["worksheet"])
+                   for source in sources]
+
+    frames, messages, errors = [], [], []
+    for source, future in zip(sources, futures):
+        try:
+            frame = future.result()
+        except Exception as e:
+            logger.warning("Could not load %s (%s / %s): %s", source["site"], source["workbook"],
+                           source["worksheet"], e)
+            messages.append(f"Could not load the data of {source['site']}: {e}")
+            errors.append(e)
+            continue
+        frames.append(frame.assign(Site=source["site"]))
+
+    if not frames:
+        raise errors[0]
+    df = pd.concat(frames, ignore_index=True)
+    # Few distinct sites over many rows: keep the column encoded
+    df["Site"] = df["Site"].astype("category")
+    return df, messages
+
+
+def clean_referrer(referrer):
+    """Clean and standardize referrer data"""
+    # Convert to string first
+    referrer_str = str(referrer).strip()
+
+    # Handle various representations of empty/null values
+    if (referrer_str in ['', 'nan', 'None', 'null', 'NaN'] or 
+        pd.isna(referrer) or 
+        referrer is None or 
+        referrer_str.lower() == 'none'):
+        return "Direct"
+
+    # If it's a full URL, extract the domain
+    if referrer_str.startswith(('http://', 'https://')):
+        try:
+            parsed = urlparse(referrer_str)
+            domain = parsed.netloc.lower()
+            # Remove www. prefix for cleaner display
+            if domain.startswith('www.'):
+                domain = domain[4:]
+            return domain if domain else "Direct"
+        except:
+            return "Direct"
+
+    # If it's already a clean domain or other referrer type, return as is
+    return referrer_str
+
+
+def duration_to_seconds(duration_str):
+    if pd.isna(duration_str) or duration_str == "":
+        return 0
+
+    duration_str = str(duration_str).strip()
+    colon_count = duration_str.count(':')
+
+    try:
+        if colon_count == 1:  # mm:ss format
+            parts = duration_str.split(':')
+            minutes = int(parts[0])
+            seconds = int(parts[1])
+            return (minutes * 60) + seconds
+        elif colon_count == 2:  # hh:mm:ss format
+            parts = duration_str.split(':')
+            hours = int(parts[0])
+            minutes = int(parts[1])
+            seconds = int(parts[2])
+            return (hours * 3600) + (minutes * 60) + seconds
+        else:
+            return 0
+    except:
+        return 0
+
+
+def normalize_user_ids(user_ids):
+    """User IDs as text, so an ID the sheet numericised matches the same ID read from a CSV export"""
+    if pd.api.types.is_float_dtype(user_ids):
+        user_ids = user_ids.astype("Int64")
+    return user_ids.astype(str)
+
+
+def preprocess_sessions(df):
+    """Clean the raw sheet rows into the session frame every metric works on
+
+    Returns the frame and a list of warnings about missing columns, which are also logged.
+    """
+    messages = []
+
+    # Data preprocessing
+    with span("preprocess.dates", rows=len(df)):
+        df["Date"] = pd.to_datetime(df["Date"], dayfirst=True, errors='coerce')
+        df = df[df["Date"].notnull()]
+        df = df[df["Clarity user ID"].notnull()]
+        df["Clarity user ID"] = normalize_user_ids(df["Clarity user ID"])
+    df["Device"] = df["Device"].fillna("Unknown")
+    df["Country"] = df["Country"].fillna("Unknown")
+
+    # Handle Site column, which load_sources adds when merging exports
+    if "Site" not in df.columns:
+        df["Site"] = DEFAULT_SOURCES[0]["site"]
+
+    # Handle OS column
+    if "OS" not in df.columns:
+        df["OS"] = "Unknown"
+    else:
+        df["OS"] = df["OS"].fillna("Unknown")
+
+    # Handle Referrer column, applying the cleaning func
+    if "Referrer" not in df.columns:
+        df["Referrer"] = "Direct"
+    else:
+        with span("preprocess.clean_referrer", rows=len(df)):
+            df["Referrer"] = df["Referrer"].apply(clean_referrer)
+
+    # Handle Page count column
+    if 'Page count' not in df.columns:
+        messages.append("Page count column not found. Using default value of 1.")
+        df['Page count'] = 1
+
+    # Handle Clicks column (if it exists)
+    if 'Session clicks' not in df.columns:
+        df['Session clicks'] = 0
+    else:
+        df['Session clicks'] = df['Session clicks'].fillna(0)
+
+    if 'Session duration' in df.columns:
+        with span("preprocess.durations", rows=len(df)):
+            df['TotalSeconds'] = df['Session duration'].apply(duration_to_seconds)
+    else:
+        messages.append("Session duration column not found. Using default value of 0.")
+        df['TotalSeconds'] = 0
+
+    for message in messages:
+        logger.warning(message)
+    return df, messages
+
+
+def dataset_version(df):
+    """Fingerprint of the loaded data, used to key cached computations"""
+    return int(pd.util.hash_pandas_object(df, index=False).sum())
+
+
+def format_duration(total_seconds):
+    if total_seconds == 0:
+        return "-"
+
+    hours = int(total_seconds // 3600)
+    minutes = int((total_seconds % 3600) // 60)
+    seconds = int(total_seconds % 60)
+
+    if hours > 0:
+        return f"{hours}h{minutes}m"
+    elif minutes > 0:
+        return f"{minutes}m{seconds}s"
+    else:
+        return f"{seconds}s"
+
+
+def format_durations(total_seconds):
+    """Vectorized format_duration: format a whole column of seconds in one operation"""
+    seconds = pd.Series(total_seconds, dtype="float64").fillna(0)
+
+    # Durations repeat heavily, so format each distinct value once and broadcast it back
+    codes, unique_seconds = pd.factorize(seconds)
+    unique_seconds = pd.Series(unique_seconds)
+    hours = (unique_seconds // 3600).astype("int64")
+    minutes = ((unique_seconds % 3600) // 60).astype("int64")
+    whole_seconds = (unique_seconds % 60).astype("int64")
+
+    hours_str = hours.astype(str)
+    minutes_str = minutes.astype(str)
+    seconds_str = whole_seconds.astype(str)
+
+    formatted = np.where(
+        hours > 0, hours_str + "h" + minutes_str + "m",
+        np.where(minutes > 0, minutes_str + "m" + seconds_str + "s", seconds_str + "s")
+    ).astype(object)
+    formatted[(unique_seconds == 0).values] = "-"
+    return pd.Series(formatted[codes], index=seconds.index, dtype=object)
+
+
+def get_comparison_dates(start_date, end_date, comparison_type):
+    """Fixed comparison date calculation"""
+    from dateutil.relativedelta import relativedelta
+
+    start_date = pd.to_datetime(start_date)
+    end_date = pd.to_datetime(end_date)
+
+    # Calculate the number of days in the selected period (inclusive)
+    period_length = (end_date - start_date).days + 1
+
+    if comparison_type == "Last Trailing Period":
+        # For trailing period: go back by the same number of days
+        # If current period is June 1-10 (10 days), trailing period should be May 22-31 (10 days)
+        comp_end_date = start_date - timedelta(days=1)  # Day before start date
+        comp_start_date = comp_end_date - timedelta(days=period_length - 1)  # Go back period_length days
+
+    elif comparison_type == "Same Period Last Year":
+        # For same period last year: same dates but previous year
+        # If current period is June 1-10 2025, comparison period is June 1-10 2024
+        comp_start_date = start_date - relativedelta(years=1)
+        comp_end_date = end_date - relativedelta(years=1)
+
+    else:  # Same Period Last Month
+        # For same period last month: same dates but previous month
+        # If current period is June 1-10, comparison period is May 1-10
+        try:
+            # Use relativedelta for proper month arithmetic
+            comp_start_date = start_date - relativedelta(months=1)
+            comp_end_date = end_date - relativedelta(months=1)
+        except:
+            # Fallback to simple subtraction if relativedelta fails
+            if start_date.month == 1:
+                comp_start_date = start_date.replace(year=start_date.year - 1, month=12)
+                comp_end_date = end_date.replace(year=end_date.year - 1, month=12)
+            else:
+                comp_start_date = start_date.replace(month=start_date.month - 1)
+                comp_end_date = end_date.replace(month=end_date.month - 1)
+
+    return comp_start_date, comp_end_date
+
+
+# Integer user codes of a persistent user_dictionary.UserDictionary, present when one is configured
+USER_CODE = "User code"
+
+
+def user_key(df):
+    """Column identifying the users of df: their dictionary codes when present, else their user IDs"""
+    return USER_CODE if USER_CODE in df.columns else "Clarity user ID"
+
+
+def user_first_seen(df):
+    """First session date of every user in df, indexed by its user_key"""
+    return df.groupby(user_key(df))["Date"].min()
+
+
+def calculate_kpis(filtered_df, df_all, period_start=None, period_end=None, first_seen=None):
+    """Calculate all KPIs for a given filtered dataframe
+
+    first_seen, the user_first_seen of the full history, replaces df_all when given.
+    """
+    kpis = {}
+    user = user_key(filtered_df)
+
+    if len(filtered_df) == 0:
+        # Return zero values if no data
+        return {
+            'unique_users': 0,
+            'new_users': 0,
+            'total_sessions': 0,
+            'returning_users': 0,
+            'avg_duration': 0,
+            'avg_duration_formatted': '-',
+            'page_views': 0,
+            'bounce_rate': 0
+        }
+
+    # Use provided period dates or fall back to actual data range
+    if period_start is not None and period_end is not None:
+        filter_start = pd.to_datetime(period_start)
+        filter_end = pd.to_datetime(period_end)
+    else:
+        filter_start = filtered_df["Date"].min()
+        filter_end = filtered_df["Date"].max()
+
+    # 1. Unique Users
+    kpis['unique_users'] = filtered_df[user].nunique()
+
+    # 2. New Users - users whose first appearance is within the filtered period
+    if first_seen is None:
+        first_seen = user_first_seen(df_all)
+    first_seen_dates = first_seen.rename_axis(user).reset_index(name="first_seen")
+
+    # Find users who first appeared in this period
+    new_users_in_period = first_seen_dates[
+        (first_seen_dates["first_seen"] >= filter_start) &
+        (first_seen_dates["first_seen"] <= filter_end)
+        ]
+
+    # Count how many of these new users are in our filtered data
+    kpis['new_users'] = filtered_df[
+        filtered_df[user].isin(new_users_in_period[user])
+    ][user].nunique()
+
+    # 3. Total Sessions
+    kpis['total_sessions'] = len(filtered_df)
+
+    # 4. Returning Users
+    # Count sessions per user in the filtered period
+    user_sessions = filtered_df.groupby(user).size().reset_index(name="session_count")
+
+    # New users with multiple sessions in the current period
+    new_returning = user_sessions[user_sessions["session_count"] > 1][user].nunique()
+
+    # Existing users (first seen before filter period) who are active in the period
+    existing_users = first_seen_dates[first_seen_dates["first_seen"] < filter_start][user]
+    existing_returning = filtered_df[
+        filtered_df[user].isin(existing_users)
+    ][user].nunique()
+
+    kpis['returning_users'] = new_returning + existing_returning
+
+    # 5. Average Session Duration
+    avg_duration_seconds = filtered_df['TotalSeconds'].mean()
+    kpis['avg_duration'] = avg_duration_seconds
+    kpis['avg_duration_formatted'] = format_duration(avg_duration_seconds)
+
+    # 6. Page Views
+    kpis['page_views'] = filtered_df['Page count'].sum()
+
+    # 7. Bounce Rate
+    user_page_counts = filtered_df.groupby(user)['Page count'].sum().reset_index()
+    users_with_one_page = len(user_page_counts[user_page_counts['Page count'] == 1])
+    total_unique_users = kpis['unique_users']
+    kpis['bounce_rate'] = (users_with_one_page / total_unique_users) * 100 if total_unique_users > 0 else 0
+
+    return kpis
+
+
+def get_comparison_windows(start_date, end_date, comparison_type, trailing_periods=0,
+                           include_last_year=False, custom_range=None):
+    """Build the list of (label, start, end) windows compared against the current period"""
+    start_date = pd.to_datetime(start_date)
+    end_date = pd.to_datetime(end_date)
+    period_length = (end_date - start_date).days + 1
+
+    comp_start_date, comp_end_date = get_comparison_dates(start_date, end_date, comparison_type)
+    windows = [
+        ("Current", start_date, end_date),
+        ("Comparison", comp_start_date, comp_end_date)
+    ]
+
+    # Previous N trailing periods, oldest first so they read left to right in a trend
+    for i in range(trailing_periods, 0, -1):
+        trailing_end = start_date - timedelta(days=period_length * (i - 1) + 1)
+        trailing_start = trailing_end - timedelta(days=period_length - 1)
+        windows.append((f"T-{i}", trailing_start, trailing_end))
+
+    if include_last_year:
+        last_year_start, last_year_end = get_comparison_dates(start_date, end_date, "Same Period Last Year")
+        windows.append(("Last Year", last_year_start, last_year_end))
+
+    if custom_range is not None:
+        windows.append(("Custom", pd.to_datetime(custom_range[0]), pd.to_datetime(custom_range[1])))
+
+    return windows
+
+
+def calculate_kpis_batch(segment_df, df_all, windows, first_seen=None):
+    """Calculate the KPIs of calculate_kpis for several date windows in one vectorized pass
+
+    segment_df holds the country/device filtered rows of every window; each window is a
+    (label, start, end) tuple. first_seen, the user_first_seen of the full history, replaces
+    df_all when given. Returns a DataFrame indexed by window label.
+    """
+    labels = [window[0] for window in windows]
+    starts = pd.to_datetime([window[1] for window in windows]).values
+    ends = pd.to_datetime([window[2] for window in windows]).values
+
+    # Sort once so every window is a contiguous slice of rows
+    segment_df = segment_df.sort_values("Date", kind="stable")
+    dates = segment_df["Date"].values
+    lo = np.searchsorted(dates, starts, side="left")
+    hi = np.searchsorted(dates, ends, side="right")
+    lengths = np.maximum(hi - lo, 0)
+
+    # Stack the row positions of all windows and tag each with its window id
+    window_ids = np.repeat(np.arange(len(windows)), lengths)
+    offsets = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    rows = np.repeat(lo, lengths) + offsets
+
+    # First appearance of every user over the full history, looked up by integer code
+    user_codes, user_ids = pd.factorize(segment_df[user_key(segment_df)])
+    if first_seen is None:
+        first_seen = user_first_seen(df_all)
+    first_seen = first_seen.reindex(user_ids).values
+
+    stacked = pd.DataFrame({
+        'window': window_ids,
+        'user': user_codes[rows],
+        'seconds': segment_df['TotalSeconds'].values[rows],
+        'pages': segment_df['Page count'].values[rows]
+    })
+
+    per_user = stacked.groupby(['window', 'user'], sort=False)['pages'].agg(['size', 'sum']).reset_index()
+    per_user_first_seen = first_seen[per_user['user'].values]
+    user_window = per_user['window'].values
+    per_user['is_new'] = (per_user_first_seen >= starts[user_window]) & (per_user_first_seen <= ends[user_window])
+    per_user['is_existing'] = per_user_first_seen < starts[user_window]
+    per_user['is_multi_session'] = per_user['size'] > 1
+    per_user['is_bounce'] = per_user['sum'] == 1
+
+    user_counts = per_user.groupby('window')[['is_new', 'is_existing', 'is_multi_session', 'is_bounce']].sum()
+    user_counts['unique_users'] = per_user.groupby('window').size()
+    window_totals = stacked.groupby('window')[['seconds', 'pages']].sum()
+
+    kpis = pd.DataFrame(index=pd.RangeIndex(len(windows)))
+    kpis = kpis.join(user_counts).join(window_totals).fillna(0)
+    kpis['total_sessions'] = lengths
+
+    result = pd.DataFrame({
+        'unique_users': kpis['unique_users'].astype(int),
+        'new_users': kpis['is_new'].astype(int),
+        'total_sessions': kpis['total_sessions'].astype(int),
+        'returning_users': (kpis['is_multi_session'] + kpis['is_existing']).astype(int),
+        'avg_duration': np.where(lengths > 0, kpis['seconds'] / np.maximum(lengths, 1), 0),
+        'page_views': kpis['pages'].astype(int) if pd.api.types.is_integer_dtype(segment_df['Page count'])
+        else kpis['pages'],
+        'bounce_rate': np.where(kpis['unique_users'] > 0,
+                                kpis['is_bounce'] / kpis['unique_users'].clip(lower=1) * 100, 0)
+    })
+    result['avg_duration_formatted'] = format_durations(result['avg_duration'])
+    result.index = labels
+    return result
+
+
+@instrumented("cohort_retention")
+def cohort_retention(df, granularity, countries, devices, start_date, end_date, max_offset=12, first_seen=None):
+    """Acquisition cohort retention matrix
+
+    Users are assigned to the week/month of their first session over the full history and
+    counted in every following period they are active in the selected countries/devices.
+    Only cohorts acquired between start_date and end_date are returned. Everything runs on
+    integer user codes and period buckets, without a loop over cohorts. first_seen, a
+    user_first_seen index maintained elsewhere, dates sessions no longer in df.
+    """
+    def to_periods(dates):
+        if granularity == "Weekly":
+            # 1970-01-01 was a Thursday, shift by 3 days so buckets start on Monday
+            return (dates.astype("datetime64[D]").astype("int64") + 3) // 7
+        return dates.astype("datetime64[M]").astype("int64")
+
+    periods = to_periods(df["Date"].values)
+
+    user_codes, user_ids = pd.factorize(df[user_key(df)])
+    first_period = pd.Series(periods).groupby(user_codes).min().values
+    if first_seen is not None:
+        first_period = np.minimum(first_period, to_periods(first_seen.reindex(user_ids).values))
+
+    # Distinct (user, period) activity inside the selected segment
+    in_segment = (df["Country"].isin(countries) & df["Device"].isin(devices)).values
+    base_period = periods.min()
+    period_span = int(periods.max() - base_period) + 1
+    activity = np.unique(user_codes[in_segment].astype("int64") * period_span + periods[in_segment] - base_period)
+    active_users = activity // period_span
+    active_periods = activity % period_span + base_period
+
+    cohorts = first_period[active_users]
+    offsets = active_periods - cohorts
+
+    # A cohort member must be active in the segment in its acquisition period
+    members = np.zeros(len(first_period), dtype=bool)
+    members[active_users[offsets == 0]] = True
+
+    first_bucket, last_bucket = to_periods(pd.to_datetime([start_date, end_date]).values)
+
+    keep = members[active_users] & (cohorts >= first_bucket) & (cohorts <= last_bucket) & (offsets <= max_offset)
+    counts = pd.DataFrame({'cohort': cohorts[keep], 'offset': offsets[keep]}).groupby(
+        ['cohort', 'offset']).size().unstack(fill_value=0)
+    if counts.empty:
+        return pd.DataFrame()
+    counts = counts.reindex(columns=range(counts.columns.max() + 1), fill_value=0)
+
+    cohort_sizes = counts[0]
+    retention = counts.div(cohort_sizes, axis=0) * 100
+
+    if granularity == "Weekly":
+        labels = (np.datetime64("1970-01-05") + (counts.index.values - 1) * 7).astype("datetime64[D]")
+    else:
+        labels = counts.index.values.astype("datetime64[M]")
+    retention.index = pd.to_datetime(labels).strftime("%Y-%m-%d" if granularity == "Weekly" else "%Y-%m")
+    retention.index.name = "Cohort"
+    retention.insert(0, "Cohort Size", cohort_sizes.values)
+    return retention
+
+
+# Relative accuracy of the quantile sketches: every estimate is within 1% of the true value
+SKETCH_RELATIVE_ACCURACY = 0.01
+SKETCH_GAMMA = (1 + SKETCH_RELATIVE_ACCURACY) / (1 - SKETCH_RELATIVE_ACCURACY)
+
+
+def sketch_buckets(values):
+    """Map values to logarithmic sketch buckets; bucket 0 holds zeros"""
+    values = np.asarray(values, dtype="float64")
+    buckets = np.zeros(len(values), dtype="int64")
+    positive = values > 0
+    buckets[positive] = np.ceil(np.log(np.maximum(values[positive], 1)) / np.log(SKETCH_GAMMA)).astype("int64") + 1
+    return buckets
+
+
+def sketch_bucket_values(buckets):
+    """Representative value of each sketch bucket"""
+    buckets = np.asarray(buckets, dtype="int64")
+    return np.where(buckets > 0, 2 * SKETCH_GAMMA ** (buckets - 1) / (SKETCH_GAMMA + 1), 0.0)
+
+
+@instrumented("build_quantile_sketches")
+def build_quantile_sketches(df):
+    """Build mergeable quantile sketches of session duration and page count per day, country and device
+
+    Each sketch is a histogram over logarithmic buckets, so sketches merge by adding counts and
+    any date range / segment combination is answered without touching the raw rows.
+    """
+    sketches = []
+    for metric, column in [('duration', 'TotalSeconds'), ('pages', 'Page count')]:
+        metric_sketch = pd.DataFrame({
+            'Date': df['Date'].values,
+            'Country': df['Country'].values,
+            'Device': df['Device'].values,
+            'bucket': sketch_buckets(df[column].values)
+        }).groupby(['Date', 'Country', 'Device', 'bucket']).size().reset_index(name='count')
+        metric_sketch.insert(0, 'metric', metric)
+        sketches.append(metric_sketch)
+
+    sketches = pd.concat(sketches, ignore_index=True)
+    for column in ['metric', 'Country', 'Device']:
+        sketches[column] = sketches[column].astype('category')
+    return sketches
+
+
+def query_sketch_quantiles(sketches, start_date, end_date, countries, devices, by=None,
+                           quantiles=(0.5, 0.9, 0.99), granularity="Daily"):
+    """Merge the sketches matching the filters and read off quantiles, optionally per Date/Country/Device
+
+    With by='Date' a Weekly or Monthly granularity merges the daily sketches of each period.
+    """
+    selected = sketches[
+        (sketches['Date'] >= pd.to_datetime(start_date)) &
+        (sketches['Date'] <= pd.to_datetime(end_date)) &
+        (sketches['Country'].isin(countries)) &
+        (sketches['Device'].isin(devices))
+        ]
+    if by == 'Date' and granularity != "Daily":
+        selected = selected.assign(Date=period_start(selected['Date'], granularity))
+
+    # Without a breakdown every selected sketch merges into one group
+    segment_key = by or 'all'
+    if by is None:
+        selected = selected.assign(all=0)
+
+    group_keys = [segment_key, 'metric']
+    merged = selected.groupby(group_keys + ['bucket'], observed=True)['count'].sum().reset_index()
+    merged = merged[merged['count'] > 0]
+    if merged.empty:
+        return pd.DataFrame()
+
+    grouped = merged.groupby(group_keys, observed=True)['count']
+    merged['cumulative'] = grouped.cumsum()
+    merged['total'] = grouped.transform('sum')
+
+    result = {}
+    for quantile in quantiles:
+        # First bucket whose cumulative count passes the quantile rank
+        reached = merged[merged['cumulative'] > quantile * (merged['total'] - 1)]
+        first_bucket = reached.groupby(group_keys, observed=True)['bucket'].first()
+        result[f"p{quantile * 100:g}"] = pd.Series(sketch_bucket_values(first_bucket.values),
+                                                  index=first_bucket.index)
+
+    result = pd.DataFrame(result).unstack('metric')
+    result = result[[(name, metric) for metric in result.columns.levels[1] for name in result.columns.levels[0]
+                     if (name, metric) in result.columns]]
+    result.columns = [f"{metric}_{name}" for name, metric in result.columns]
+    return result.reset_index(drop=by is None)
+
+
+# The largest filtered selection that is still ranked from the raw rows; larger ones are summed
+# from the per-day referrer counts
+EXACT_REFERRER_MAX_ROWS = 100_000
+
+
+@instrumented("build_referrer_counts")
+def build_referrer_counts(df):
+    """Exact session counts per day, country, device and referrer
+
+    The counts merge by addition, so any date range and segment is ranked exactly without touching
+    the raw rows. They are not capped: clean_referrer reduces referrers to domains, and there is one
+    count per domain seen in a day and segment.
+    """
+    counts = df.groupby(['Date', 'Country', 'Device', 'Referrer']).size().reset_index(name='Sessions')
+    for column in ['Country', 'Device', 'Referrer']:
+        counts[column] = counts[column].astype('category')
+    return counts
+
+
+def rank_referrers(sessions, top_k=15):
+    """The top_k referrers of a session count per referrer, ties ranked by name like the other backends"""
+    ranked = sessions.rename_axis('Referrer').reset_index(name='Sessions')
+    ranked['Referrer'] = ranked['Referrer'].astype(str)
+    return ranked.sort_values(['Sessions', 'Referrer'], ascending=[False, True]).head(top_k).reset_index(drop=True)
+
+
+def merge_referrer_counts(counts, start_date, end_date, countries, devices, top_k=15):
+    """Top_k referrers of the filtered rows, summed from the per-day referrer counts"""
+    selected = filter_sessions(counts, start_date, end_date, countries, devices)
+    return rank_referrers(selected.groupby('Referrer', observed=True)['Sessions'].sum(), top_k)
+
+
+# Time-series charts never send more than this many points per trace to the browser
+MAX_CHART_POINTS = 400
+
+
+def choose_time_granularity(start_date, end_date):
+    """Daily buckets for short ranges, weekly or monthly ones for wide ranges"""
+    days = (pd.to_datetime(end_date) - pd.to_datetime(start_date)).days + 1
+    if days > 730:
+        return "Monthly"
+    elif days > 180:
+        return "Weekly"
+    return "Daily"
+
+
+def period_start(dates, granularity):
+    """First day of the week (Monday) or month containing each date"""
+    dates = pd.DatetimeIndex(dates).normalize()
+    if granularity == "Weekly":
+        return dates - pd.to_timedelta(dates.weekday, unit="D")
+    elif granularity == "Monthly":
+        return dates.to_period("M").to_timestamp()
+    return dates
+
+
+def lttb_indices(x, y, threshold):
+    """Largest-Triangle-Three-Buckets: indices of threshold points that preserve the shape of (x, y)
+
+    The first and last points are always kept; every bucket in between keeps the point forming the
+    largest triangle with the previously kept point and the average of the next bucket, so peaks
+    and troughs survive the downsampling.
+    """
+    x = np.asarray(x, dtype="float64")
+    y = np.asarray(y, dtype="float64")
+    n = len(x)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    # Bucket boundaries over the interior points
+    edges = (np.arange(threshold - 1) * (n - 2) / (threshold - 2)).astype("int64") + 1
+    edges[-1] = n - 1
+
+    selected = np.empty(threshold, dtype="int64")
+    selected[0] = 0
+    selected[-1] = n - 1
+    previous = 0
+    for bucket in range(threshold - 2):
+        lo, hi = edges[bucket], edges[bucket + 1]
+        next_lo, next_hi = hi, (edges[bucket + 2] if bucket + 2 < len(edges) else n)
+        next_x = x[next_lo:next_hi].mean()
+        next_y = y[next_lo:next_hi].mean()
+
+        areas = np.abs(
+            (x[previous] - next_x) * (y[lo:hi] - y[previous]) -
+            (x[previous] - x[lo:hi]) * (next_y - y[previous])
+        )
+        previous = lo + int(np.argmax(areas))
+        selected[bucket + 1] = previous
+    return selected
+
+
+def downsample_time_series(data, x, y, max_points=MAX_CHART_POINTS):
+    """Downsample every y column of a time-indexed frame with LTTB, returning long-format rows"""
+    x_values = pd.to_datetime(data[x]).values.astype("int64")
+    traces = []
+    for column in y:
+        keep = lttb_indices(x_values, data[column].values, max_points)
+        trace = data.iloc[keep][[x, column]].rename(columns={column: 'Value'})
+        trace['Series'] = column
+        traces.append(trace)
+    return pd.concat(traces, ignore_index=True)
+
+
+def filter_sessions(sessions, start_date, end_date, countries, devices):
+    """Rows of sessions within the date range and the selected countries and devices"""
+    return sessions[
+        (sessions["Date"] >= pd.to_datetime(start_date)) &
+        (sessions["Date"] <= pd.to_datetime(end_date)) &
+        (sessions["Country"].isin(countries)) &
+        (sessions["Device"].isin(devices))
+        ]
+
+
+@instrumented("window_kpis")
+def window_kpis(df, countries, devices, windows, first_seen=None):
+    """KPIs of every comparison window for the selected countries and devices"""
+    segment_df = df[(df["Country"].isin(countries)) & (df["Device"].isin(devices))]
+    return calculate_kpis_batch(segment_df, df, windows, first_seen)
+
+
+@instrumented("sessions_by")
+def sessions_by(df, key, start_date, end_date, countries, devices):
+    """Session counts of the filtered rows grouped by a column, or by 'Weekday'"""
+    filtered_df = filter_sessions(df, start_date, end_date, countries, devices)
+    if key == 'Weekday':
+        groups = filtered_df['Date'].dt.day_name().rename('Weekday')
+    else:
+        groups = filtered_df[key]
+    return filtered_df.groupby(groups).size()
+
+
+@instrumented("build_daily_segments")
+def build_daily_segments(df):
+    """Sessions, page views and seconds per day, country, device and OS, as an AggregateStore keeps them"""
+    return pd.DataFrame({
+        'Date': df['Date'].values,
+        'Country': df['Country'].values,
+        'Device': df['Device'].values,
+        'OS': df['OS'].values,
+        'pages': df['Page count'].values,
+        'seconds': df['TotalSeconds'].to_numpy(dtype="float64")
+    }).groupby(['Date', 'Country', 'Device', 'OS']).agg(
+        sessions=('pages', 'size'), page_views=('pages', 'sum'), seconds=('seconds', 'sum')
+    ).reset_index()
+
+
+def segment_sessions_by(segments, key, start_date, end_date, countries, devices):
+    """sessions_by answered from daily segment aggregates rather than raw rows
+
+    segments has a sessions count per Date, Country, Device and OS, as built by build_daily_segments.
+    """
+    selected = filter_sessions(segments, start_date, end_date, countries, devices)
+    if key == 'Weekday':
+        groups = selected['Date'].dt.day_name().rename('Weekday')
+    else:
+        groups = selected[key]
+    return selected.groupby(groups)['sessions'].sum().rename(None)
+
+
+@instrumented("country_breakdown")
+def country_breakdown(df, start_date, end_date, countries, devices, first_seen=None):
+    """Country breakdown table of the filtered rows"""
+    filtered_df = filter_sessions(df, start_date, end_date, countries, devices)
+    if len(filtered_df) == 0:
+        return pd.DataFrame()
+    if first_seen is None:
+        first_seen = user_first_seen(df)
+
+    # Calculate country metrics
+    country_metrics = []
+
+    for country in filtered_df['Country'].unique():
+        country_data = filtered_df[filtered_df['Country'] == country]
+
+        # Calculate metrics for this country
+        country_kpis = calculate_kpis(country_data, df, start_date, end_date, first_seen)
+
+        country_metrics.append({
+            'Country': country,
+            'Total Unique Users': country_kpis['unique_users'],
+            'New Users': country_kpis['new_users'],
+            'Sessions': country_kpis['total_sessions'],
+            'Time Spent': country_data['TotalSeconds'].sum()
+        })
+
+    # Convert to DataFrame, format durations in one pass and sort by sessions
+    country_df = pd.DataFrame(country_metrics)
+    country_df['Time Spent'] = format_durations(country_df['Time Spent'])
+    return country_df.sort_values('Sessions', ascending=False)
+
+
+def exact_top_referrers(filtered_df, top_k=15):
+    """Top referrers ranked from the filtered rows"""
+    return rank_referrers(filtered_df['Referrer'].value_counts(), top_k)
+
+
+@instrumented("top_referrers")
+def top_referrers(df, start_date, end_date, countries, devices, top_k=15, referrer_counts=None):
+    """Top referrers of the filtered rows, summed from the per-day referrer counts for large selections
+
+    referrer_counts are the build_referrer_counts of df, built on demand if omitted.
+    """
+    filtered_df = filter_sessions(df, start_date, end_date, countries, devices)
+    if len(filtered_df) <= EXACT_REFERRER_MAX_ROWS:
+        return exact_top_referrers(filtered_df, top_k)
+
+    # Large selections sum the pre-built per-day referrer counts
+    if referrer_counts is None:
+        referrer_counts = build_referrer_counts(df)
+    return merge_referrer_counts(referrer_counts, start_date, end_date, countries, devices, top_k)
+
+
+@instrumented("top_users")
+def top_users(df, start_date, end_date, countries, devices):
+    """Top 10 users of the filtered rows by sessions"""
+    filtered_df = filter_sessions(df, start_date, end_date, countries, devices)
+
+    # Calculate user metrics, grouped by the integer codes when the frame carries them
+    user_metrics = filtered_df.groupby(filtered_df[user_key(filtered_df)].to_numpy()).agg({
+        'Clarity user ID': 'first',
+        'Country': 'first',
+        'Device': 'first',
+        'Referrer': 'first',
+        'Date': 'count',  # Sessions count
+        'Session clicks': 'sum',  # Total clicks
+        'Page count': 'sum',  # Total page views
+        'TotalSeconds': 'sum'  # Total time spent
+    }).reset_index(drop=True)
+
+    user_metrics.columns = ['Clarity User ID', 'Country', 'Device', 'Referrer', 'Sessions', 'Session Clicks',
+                            'Page Views', 'Time Spent']
+    # Ties are broken by user ID, as the other backends do
+    user_metrics = user_metrics.sort_values(['Sessions', 'Clarity User ID'], ascending=[False, True]).head(10)
+    user_metrics['Time Spent'] = format_durations(user_metrics['Time Spent'])
+    return user_metrics
+
+
+@instrumented("new_users")
+def new_users(df, start_date, end_date, countries, devices, first_seen=None):
+    """Users first seen in the period, with their latest visit in the filtered rows"""
+    filtered_df = filter_sessions(df, start_date, end_date, countries, devices)
+
+    # Find new users (first appearance in the filtered period)
+    if first_seen is None:
+        first_seen = user_first_seen(df)
+    user = user_key(df)
+    first_seen_dates = first_seen.rename_axis(user).reset_index(name="first_seen")
+    new_users_in_period = first_seen_dates[
+        (first_seen_dates["first_seen"] >= pd.to_datetime(start_date)) &
+        (first_seen_dates["first_seen"] <= pd.to_datetime(end_date))
+        ]
+
+    # Get new users data from filtered dataframe
+    new_users_data = filtered_df[
+        filtered_df[user].isin(new_users_in_period[user])
+    ]
+
+    # Get latest visit date for each new user
+    new_user_metrics = new_users_data.groupby(new_users_data[user].to_numpy()).agg({
+        'Clarity user ID': 'first',
+        'Country': 'first',
+        'Device': 'first',
+        'Referrer': 'first',
+        'Date': 'max',  # Latest date
+        'TotalSeconds': 'sum'  # Total time spent
+    }).reset_index(drop=True)
+
+    new_user_metrics.columns = ['Clarity User ID', 'Country', 'Device', 'Referrer', 'Latest Visit Date',
+                                'Time Spent']
+    new_user_metrics = new_user_metrics.sort_values(['Latest Visit Date', 'Clarity User ID'],
+                                                    ascending=[False, True])
+    new_user_metrics['Time Spent'] = format_durations(new_user_metrics['Time Spent'])
+    return new_user_metrics
+
+
+# Execution backends for the section queries, selected by name
+BACKENDS = ["pandas", "duckdb", "partitioned"]
+
+
+class PandasBackend:
+    """Section queries answered by the pandas functions above on an in-memory session frame
+
+    first_seen, a user_first_seen index maintained elsewhere, saves recomputing it on every query.
+    """
+
+    def __init__(self, df, first_seen=None):
+        self.df = df
+        self.first_seen = first_seen
+        self._segments = None
+        self._lock = threading.Lock()
+
+    def segments(self):
+        """Daily segment aggregates of the frame, built by the first query that needs them"""
+        with self._lock:
+            if self._segments is None:
+                self._segments = build_daily_segments(self.df)
+        return self._segments
+
+    def window_kpis(self, countries, devices, windows):
+        return window_kpis(self.df, countries, devices, windows, self.first_seen)
+
+    def sessions_by(self, key, start_date, end_date, countries, devices):
+        # Every key is a column of the daily segment aggregates, so no raw rows are scanned
+        return segment_sessions_by(self.segments(), key, start_date, end_date, countries, devices)
+
+    def country_breakdown(self, start_date, end_date, countries, devices):
+        return country_breakdown(self.df, start_date, end_date, countries, devices, self.first_seen)
+
+    def top_referrers(self, start_date, end_date, countries, devices, top_k=15, referrer_counts=None):
+        return top_referrers(self.df, start_date, end_date, countries, devices, top_k, referrer_counts)
+
+    def top_users(self, start_date, end_date, countries, devices):
+        return top_users(self.df, start_date, end_date, countries, devices)
+
+    def new_users(self, start_date, end_date, countries, devices):
+        return new_users(self.df, start_date, end_date, countries, devices, self.first_seen)
+
+
+def make_backend(df, backend="pandas", parquet_path="data/sessions.parquet", store_path="data/sessions",
+                 first_seen=None):
+    """Section query backend over the preprocessed sessions
+
+    "pandas" queries the frame itself, "duckdb" a Parquet copy of it and "partitioned" a
+    month-partitioned store that only loads the months a query touches, written from df unless
+    ingest_exports fills it. first_seen, when given, is used by every backend in place of the
+    first sessions of df.
+    """
+    if backend == "pandas":
+        return PandasBackend(df, first_seen)
+    elif backend == "duckdb":
+        from duckdb_backend import DuckDBBackend
+
+        return DuckDBBackend.from_frame(df, parquet_path, first_seen=first_seen)
+    elif backend == "partitioned":
+        from partitioned_store import PartitionedBackend
+
+        # A store filled by ingest_exports holds exports df lacks, so it is opened rather than rewritten
+        return PartitionedBackend.open_or_write(df, store_path, first_seen=first_seen)
+    raise ValueError(f"Unknown analytics backend {backend!r}, expected one of {BACKENDS}")
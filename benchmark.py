@@ -0,0 +1,140 @@
+"""Scaling benchmark of the dashboard's compute path on synthetic Clarity exports
+
+Every stage runs on a table from synthetic_data with a fixed seed, so runs on different commits
+measure the same work. Wall time is the median of --repeat runs; peak memory is measured in a
+separate traced run so tracemalloc's overhead does not distort the timings.
+
+Examples:
+    python benchmark.py --sizes 10000 100000 --output bench_before.json
+    python benchmark.py --sizes 10000 100000 --output bench_after.json --compare bench_before.json
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import timedelta
+
+import numpy as np
+import pandas as pd
+
+import analytics_core as core
+from parallel_precompute import precompute_aggregates
+from synthetic_data import generate_clarity_export
+
+DEFAULT_SIZES = [10_000, 100_000, 1_000_000]
+
+
+def measure(stage, repeat):
+    """Median wall time over repeat runs and the traced peak memory of one more run"""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = stage()
+        timings.append(time.perf_counter() - started)
+
+    tracemalloc.start()
+    stage()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, {'seconds': statistics.median(timings), 'peak_mb': peak / 2 ** 20}
+
+
+def benchmark_size(rows, seed, repeat, data_dir, workers=None):
+    """Time every stage on one table size, returning {stage: measurement}"""
+    csv_path = os.path.join(data_dir, f"clarity_{rows}_{seed}.csv")
+    if not os.path.exists(csv_path):
+        generate_clarity_export(rows, seed=seed).to_csv(csv_path, index=False)
+
+    results = {}
+    raw, results['ingest_csv'] = measure(lambda: pd.read_csv(csv_path), repeat)
+    (df, _), results['preprocess'] = measure(lambda: core.preprocess_sessions(raw.copy()), repeat)
+
+    # The dashboard's default view: the last 30 days of every country and device
+    end_date = df["Date"].max()
+    start_date = end_date - timedelta(days=29)
+    countries = tuple(sorted(df["Country"].unique()))
+    devices = tuple(sorted(df["Device"].unique()))
+    filter_state = (start_date, end_date, countries, devices)
+
+    filtered_df, results['filter'] = measure(lambda: core.filter_sessions(df, *filter_state), repeat)
+    _, results['calculate_kpis'] = measure(
+        lambda: core.calculate_kpis(filtered_df, df, start_date, end_date), repeat)
+    windows = core.get_comparison_windows(start_date, end_date, core.COMPARISON_TYPES[0], trailing_periods=4)
+    _, results['window_kpis'] = measure(lambda: core.window_kpis(df, countries, devices, windows), repeat)
+    _, results['country_breakdown'] = measure(lambda: core.country_breakdown(df, *filter_state), repeat)
+    _, results['top_users'] = measure(lambda: core.top_users(df, *filter_state), repeat)
+    _, results['new_users'] = measure(lambda: core.new_users(df, *filter_state), repeat)
+    _, results['precompute'] = measure(lambda: precompute_aggregates(df, workers), repeat)
+
+    for measurement in results.values():
+        measurement['rows'] = rows
+    return results
+
+
+def environment():
+    """Commit and library versions the results were measured with"""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        'commit': commit or None,
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count()
+    }
+
+
+def print_results(results, baseline=None):
+    """Table of seconds and peak MB per size and stage, with the speedup against a baseline"""
+    header = f"{'rows':>10}  {'stage':<18} {'seconds':>9} {'peak MB':>9}"
+    print(header + ("  vs baseline" if baseline else ""))
+    for size, stages in results.items():
+        for stage, measurement in stages.items():
+            line = f"{size:>10}  {stage:<18} {measurement['seconds']:>9.4f} {measurement['peak_mb']:>9.1f}"
+            previous = (baseline or {}).get(size, {}).get(stage)
+            if previous:
+                line += f"  {previous['seconds'] / max(measurement['seconds'], 1e-9):.2f}x"
+            print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the analytics compute path on synthetic data.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+                        help="Table sizes in rows (10000000 is supported but slow)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3, help="Timed runs per stage; the median is reported")
+    parser.add_argument("--workers", type=int, help="Processes of the precompute stage (default: one per core)")
+    parser.add_argument("--data-dir", help="Keep the generated CSVs here between runs (default: a temp dir)")
+    parser.add_argument("--output", help="Write the results as JSON")
+    parser.add_argument("--compare", help="Results JSON of an earlier run to report speedups against")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        data_dir = args.data_dir or temp_dir
+        os.makedirs(data_dir, exist_ok=True)
+        results = {str(rows): benchmark_size(rows, args.seed, args.repeat, data_dir, args.workers)
+                   for rows in args.sizes}
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+    print_results(results, baseline)
+
+    if args.output:
+        with open(args.output, "w") as output_file:
+            json.dump({'environment': environment(), 'seed': args.seed, 'repeat': args.repeat,
+                       'results': results}, output_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
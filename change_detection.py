@@ -0,0 +1,194 @@
+"""Cheap checks of whether a session source changed since it was last loaded
+
+A probe reads the state of a source (its modification time, its data row count and a fingerprint
+of its last row) with a few small requests instead of a full download. When the modification
+time is unchanged that is a single metadata request and the refresh is a no-op. Otherwise the
+rows are compared: if the last row loaded before is still in place and rows were added after it,
+the refresh is an append and only the new rows are fetched; any other change is a rewrite and
+the source is reloaded in full.
+"""
+import csv
+import hashlib
+import itertools
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+
+from analytics_core import SHEET_SCOPES, preprocess_sessions
+from instrumentation import span
+
+logger = logging.getLogger(__name__)
+
+UNCHANGED, APPEND, REWRITE = "unchanged", "append", "rewrite"
+
+
+def fingerprint_row(values):
+    """Stable hash of one row's cell values"""
+    return hashlib.sha1("\x1f".join(str(value) for value in values).encode()).hexdigest()
+
+
+class SourceProbe:
+    """Change detection shared by the probes; subclasses read the source"""
+
+    def modified(self):
+        """Modification marker of the whole source, the cheapest thing to read"""
+        raise NotImplementedError
+
+    def row_count(self):
+        """Number of data rows, not counting the header"""
+        raise NotImplementedError
+
+    def row_fingerprint(self, row):
+        """fingerprint_row of the 1-based data row"""
+        raise NotImplementedError
+
+    def fetch_rows(self, start, stop):
+        """Raw records of the data rows after start up to and including stop, as a frame"""
+        raise NotImplementedError
+
+    def check(self, previous=None):
+        """Classify the change since the previous state, returning (kind, state)"""
+        modified = self.modified()
+        if previous is not None and modified == previous['modified']:
+            return UNCHANGED, previous
+
+        rows = self.row_count()
+        state = {'modified': modified, 'rows': rows, 'last_row': self.row_fingerprint(rows) if rows else None}
+        # Only rows added after an untouched last row make an append; anything else, including an
+        # edit that keeps the row count, needs a full reload
+        if (previous is not None and 0 < previous['rows'] < rows and
+                self.row_fingerprint(previous['rows']) == previous['last_row']):
+            return APPEND, state
+        return REWRITE, state
+
+
+class SheetProbe(SourceProbe):
+    """Probe of one worksheet: the Drive modification time, then single-row reads"""
+
+    def __init__(self, credentials_dict, workbook, worksheet):
+        self.credentials_dict = credentials_dict
+        self.workbook = workbook
+        self.worksheet = worksheet
+        self._spreadsheet = None
+
+    def spreadsheet(self):
+        if self._spreadsheet is None:
+            import gspread
+            from google.oauth2.service_account import Credentials
+
+            creds = Credentials.from_service_account_info(self.credentials_dict, scopes=SHEET_SCOPES)
+            self._spreadsheet = gspread.authorize(creds).open(self.workbook)
+        return self._spreadsheet
+
+    def modified(self):
+        return self.spreadsheet().get_lastUpdateTime()
+
+    def row_count(self):
+        # The first column is the date of every session row, so its length counts the rows
+        return max(len(self.spreadsheet().worksheet(self.worksheet).col_values(1)) - 1, 0)
+
+    def row_fingerprint(self, row):
+        return fingerprint_row(self.spreadsheet().worksheet(self.worksheet).row_values(row + 1))
+
+    def fetch_rows(self, start, stop):
+        from gspread.utils import numericise_all, to_records
+
+        worksheet = self.spreadsheet().worksheet(self.worksheet)
+        if start == 0:
+            # Rows appended since the check are left for the next refresh, which sees them as an append
+            return pd.DataFrame(worksheet.get_all_records()[:stop])
+        # Read the header and the new rows only, converted to records like get_all_records does
+        header = worksheet.row_values(1)
+        values = worksheet.get(f"{start + 2}:{stop + 1}", pad_values=True)
+        values = [numericise_all(row + [""] * (len(header) - len(row))) for row in values]
+        return pd.DataFrame(to_records(header, values), columns=header)
+
+
+class FileProbe(SourceProbe):
+    """Local stand-in for a worksheet: a CSV export, probed through its modification time"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def modified(self):
+        return os.stat(self.path).st_mtime_ns
+
+    def row_count(self):
+        with open(self.path, newline="") as source:
+            return max(sum(1 for _ in csv.reader(source)) - 1, 0)
+
+    def row_fingerprint(self, row):
+        with open(self.path, newline="") as source:
+            return fingerprint_row(next(itertools.islice(csv.reader(source), row, None)))
+
+    def fetch_rows(self, start, stop):
+        return pd.read_csv(self.path, skiprows=range(1, start + 1), nrows=stop - start)
+
+
+def make_probe(source, credentials_dict=None):
+    """FileProbe of a source with a path, SheetProbe of one with a workbook and worksheet"""
+    if "path" in source:
+        return FileProbe(source["path"])
+    return SheetProbe(credentials_dict, source["workbook"], source["worksheet"])
+
+
+class SourceMirror:
+    """Preprocessed rows of one site's source, kept in step with it by cheap refreshes"""
+
+    def __init__(self, probe, site):
+        self.probe = probe
+        self.site = site
+        self.state = None
+        self.sessions = pd.DataFrame()
+        self.messages = []
+        self._lock = threading.Lock()
+
+    def refresh(self):
+        """Bring the rows up to date with the source, returning the kind of change found"""
+        with self._lock, span("refresh_source", site=self.site) as record:
+            kind, state = self.probe.check(self.state)
+            record['change'] = kind
+            if kind == UNCHANGED:
+                return kind
+
+            start = self.state['rows'] if kind == APPEND else 0
+            rows = self.probe.fetch_rows(start, state['rows'])
+            record['rows'] = len(rows)
+            # Preprocessing works row by row, so appended rows are preprocessed on their own
+            sessions, messages = (preprocess_sessions(rows.assign(Site=self.site)) if len(rows)
+                                  else (pd.DataFrame(), []))
+            if kind == APPEND:
+                self.sessions = pd.concat([self.sessions, sessions], ignore_index=True)
+            else:
+                self.sessions, self.messages = sessions, messages
+            self.state = state
+        logger.info("Refreshed %s: %s, %d new row(s)", self.site, kind, len(rows))
+        return kind
+
+
+def refresh_mirrors(mirrors):
+    """Refresh every mirror concurrently, returning {site: kind} and a warning per failed source"""
+    with ThreadPoolExecutor(max_workers=len(mirrors)) as pool:
+        futures = [pool.submit(mirror.refresh) for mirror in mirrors]
+
+    kinds, messages = {}, []
+    for mirror, future in zip(mirrors, futures):
+        try:
+            kinds[mirror.site] = future.result()
+        except Exception as e:
+            logger.warning("Could not refresh %s: %s", mirror.site, e)
+            messages.append(f"Could not refresh the data of {mirror.site}: {e}")
+    return kinds, messages
+
+
+def merge_mirrors(mirrors):
+    """Sessions of every mirror in one frame with an encoded Site column"""
+    frames = [mirror.sessions for mirror in mirrors if len(mirror.sessions)]
+    if not frames:
+        return pd.DataFrame()
+    df = pd.concat(frames, ignore_index=True)
+    df["Site"] = df["Site"].astype("category")
+    return df
@@ -0,0 +1,238 @@
+"""DuckDB execution backend: the section queries of analytics_core as SQL over Parquet
+
+The sessions live in a Parquet file (or a glob of them) that DuckDB scans out of core, so the
+queries work on histories larger than memory. Every method returns the same frame, with the same
+columns and values, as the pandas function of the same name in analytics_core.
+
+DuckDB is only imported when this backend is used.
+"""
+import os
+
+import pandas as pd
+
+from analytics_core import format_durations
+from instrumentation import instrumented
+
+INTEGER_TYPES = ("TINYINT", "SMALLINT", "INTEGER", "BIGINT")
+
+# Columns of the preprocessed session frame that the queries read
+SESSION_COLUMNS = ["Date", "Clarity user ID", "Country", "Device", "OS", "Referrer", "Page count", "Session clicks",
+                   "TotalSeconds"]
+
+
+def write_sessions_parquet(df, parquet_path):
+    """Write the preprocessed sessions as Parquet, with their original row order kept as row_id"""
+    directory = os.path.dirname(parquet_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    sessions = df[SESSION_COLUMNS].reset_index(drop=True)
+    sessions.insert(0, 'row_id', range(len(sessions)))
+    sessions.to_parquet(parquet_path, index=False)
+
+
+class DuckDBBackend:
+    """Section queries answered by DuckDB over a Parquet store of preprocessed sessions"""
+
+    def __init__(self, parquet_path, memory_limit=None, first_seen=None):
+        try:
+            import duckdb
+        except ImportError:
+            raise RuntimeError("The duckdb backend needs the duckdb package: pip install duckdb")
+
+        self.connection = duckdb.connect(":memory:")
+        if memory_limit:
+            self.connection.execute(f"SET memory_limit = '{memory_limit}'")
+        # Views cannot take prepared parameters, so the path is quoted as a SQL literal
+        quoted_path = "'" + str(parquet_path).replace("'", "''") + "'"
+        self.connection.execute(f"CREATE VIEW sessions AS SELECT * FROM read_parquet({quoted_path})")
+        self.column_types = dict(self.connection.execute("SELECT column_name, column_type FROM "
+                                                         "(DESCRIBE sessions)").fetchall())
+        self.create_first_seen(first_seen)
+
+    def create_first_seen(self, first_seen=None):
+        """The first_seen table of every user's first session date, read by the user queries
+
+        first_seen, a user_first_seen index by user ID maintained elsewhere, dates sessions no longer
+        in the Parquet file; users it lacks fall back to their first stored session.
+        """
+        stored = 'SELECT "Clarity user ID", MIN("Date") AS first_seen FROM sessions GROUP BY 1'
+        if first_seen is None:
+            self.connection.execute(f"CREATE TABLE first_seen AS {stored}")
+            return
+
+        index = pd.DataFrame({'Clarity user ID': first_seen.index.to_numpy(), 'first_seen': first_seen.to_numpy()})
+        self.connection.register('first_seen_index', index)
+        try:
+            self.connection.execute(f'''
+                CREATE TABLE first_seen AS
+                SELECT "Clarity user ID", MIN(first_seen) AS first_seen
+                FROM (SELECT * FROM first_seen_index UNION ALL {stored})
+                GROUP BY 1
+            ''')
+        finally:
+            self.connection.unregister('first_seen_index')
+
+    @classmethod
+    def from_frame(cls, df, parquet_path, memory_limit=None, first_seen=None):
+        """Backend over a fresh Parquet copy of a preprocessed session frame"""
+        write_sessions_parquet(df, parquet_path)
+        return cls(parquet_path, memory_limit, first_seen)
+
+    def query(self, sql, parameters=None):
+        """Run a query on a cursor of its own, so sessions on different threads can query concurrently"""
+        cursor = self.connection.cursor()
+        try:
+            return cursor.execute(sql, parameters or []).df()
+        finally:
+            cursor.close()
+
+    # Filter shared by every section query; parameters are start, end, countries, devices
+    FILTER = ('"Date" BETWEEN ? AND ? AND list_contains(?, "Country") AND list_contains(?, "Device")')
+
+    def sum_of(self, column):
+        """SUM of a column, kept integral for integer columns like pandas does"""
+        if self.column_types[column] in INTEGER_TYPES:
+            return f'SUM("{column}")::BIGINT'
+        return f'SUM("{column}")'
+
+    @staticmethod
+    def filter_parameters(start_date, end_date, countries, devices):
+        return [pd.to_datetime(start_date), pd.to_datetime(end_date), list(countries), list(devices)]
+
+    @instrumented("duckdb.window_kpis")
+    def window_kpis(self, countries, devices, windows):
+        """KPIs of every comparison window for the selected countries and devices"""
+        labels = [window[0] for window in windows]
+        window_frame = pd.DataFrame({
+            'window_id': range(len(windows)),
+            'start_date': pd.to_datetime([window[1] for window in windows]),
+            'end_date': pd.to_datetime([window[2] for window in windows])
+        })
+
+        cursor = self.connection.cursor()
+        try:
+            cursor.register('windows', window_frame)
+            kpis = cursor.execute('''
+                WITH per_user AS (
+                    SELECT w.window_id, s."Clarity user ID" AS user_id, COUNT(*) AS sessions,
+                           SUM(s."Page count") AS pages, SUM(s."TotalSeconds") AS seconds
+                    FROM windows w
+                    JOIN sessions s ON s."Date" BETWEEN w.start_date AND w.end_date
+                    WHERE list_contains(?, s."Country") AND list_contains(?, s."Device")
+                    GROUP BY 1, 2
+                )
+                SELECT p.window_id,
+                       COUNT(*) AS unique_users,
+                       COUNT(*) FILTER (WHERE f.first_seen BETWEEN w.start_date AND w.end_date) AS new_users,
+                       SUM(p.sessions) AS total_sessions,
+                       COUNT(*) FILTER (WHERE p.sessions > 1)
+                           + COUNT(*) FILTER (WHERE f.first_seen < w.start_date) AS returning_users,
+                       SUM(p.seconds) / SUM(p.sessions) AS avg_duration,
+                       SUM(p.pages) AS page_views,
+                       COUNT(*) FILTER (WHERE p.pages = 1) * 100.0 / COUNT(*) AS bounce_rate
+                FROM per_user p
+                JOIN first_seen f ON f."Clarity user ID" = p.user_id
+                JOIN windows w USING (window_id)
+                GROUP BY 1
+            ''', [list(countries), list(devices)]).df()
+        finally:
+            cursor.close()
+
+        kpis = kpis.set_index('window_id').reindex(range(len(windows))).fillna(0)
+        result = pd.DataFrame({
+            'unique_users': kpis['unique_users'].astype(int),
+            'new_users': kpis['new_users'].astype(int),
+            'total_sessions': kpis['total_sessions'].astype(int),
+            'returning_users': kpis['returning_users'].astype(int),
+            'avg_duration': kpis['avg_duration'].astype(float),
+            'page_views': kpis['page_views'].astype(int) if self.column_types["Page count"] in INTEGER_TYPES
+            else kpis['page_views'],
+            'bounce_rate': kpis['bounce_rate'].astype(float)
+        })
+        result['avg_duration_formatted'] = format_durations(result['avg_duration'])
+        result.index = labels
+        return result
+
+    @instrumented("duckdb.sessions_by")
+    def sessions_by(self, key, start_date, end_date, countries, devices):
+        """Session counts of the filtered rows grouped by a column, or by 'Weekday'"""
+        group = 'dayname("Date")' if key == 'Weekday' else f'"{key}"'
+        counts = self.query(f'''
+            SELECT {group} AS "{key}", COUNT(*) AS sessions
+            FROM sessions WHERE {self.FILTER}
+            GROUP BY 1 ORDER BY 1
+        ''', self.filter_parameters(start_date, end_date, countries, devices))
+        return counts.set_index(key)['sessions'].rename(None)
+
+    @instrumented("duckdb.country_breakdown")
+    def country_breakdown(self, start_date, end_date, countries, devices):
+        """Country breakdown table of the filtered rows"""
+        parameters = self.filter_parameters(start_date, end_date, countries, devices)
+        country_df = self.query(f'''
+            SELECT "Country",
+                   COUNT(DISTINCT "Clarity user ID") AS "Total Unique Users",
+                   COUNT(DISTINCT "Clarity user ID") FILTER (WHERE first_seen BETWEEN ? AND ?) AS "New Users",
+                   COUNT(*) AS "Sessions",
+                   SUM("TotalSeconds") AS "Time Spent"
+            FROM sessions JOIN first_seen USING ("Clarity user ID")
+            WHERE {self.FILTER}
+            GROUP BY 1 ORDER BY "Sessions" DESC, "Country"
+        ''', parameters[:2] + parameters)
+        if len(country_df) == 0:
+            return pd.DataFrame()
+
+        for column in ['Total Unique Users', 'New Users', 'Sessions']:
+            country_df[column] = country_df[column].astype(int)
+        country_df['Time Spent'] = format_durations(country_df['Time Spent'])
+        return country_df
+
+    @instrumented("duckdb.top_referrers")
+    def top_referrers(self, start_date, end_date, countries, devices, top_k=15, referrer_counts=None):
+        """Top referrers of the filtered rows, ranked by DuckDB itself so referrer_counts are not needed"""
+        top_referrers = self.query(f'''
+            SELECT "Referrer", COUNT(*) AS "Sessions"
+            FROM sessions WHERE {self.FILTER}
+            GROUP BY 1 ORDER BY 2 DESC, 1 LIMIT ?
+        ''', self.filter_parameters(start_date, end_date, countries, devices) + [top_k])
+        top_referrers['Sessions'] = top_referrers['Sessions'].astype(int)
+        return top_referrers
+
+    @instrumented("duckdb.top_users")
+    def top_users(self, start_date, end_date, countries, devices):
+        """Top 10 users of the filtered rows by sessions"""
+        user_metrics = self.query(f'''
+            SELECT "Clarity user ID" AS "Clarity User ID",
+                   arg_min("Country", row_id) AS "Country",
+                   arg_min("Device", row_id) AS "Device",
+                   arg_min("Referrer", row_id) AS "Referrer",
+                   COUNT(*) AS "Sessions",
+                   {self.sum_of("Session clicks")} AS "Session Clicks",
+                   {self.sum_of("Page count")} AS "Page Views",
+                   SUM("TotalSeconds") AS "Time Spent"
+            FROM sessions WHERE {self.FILTER}
+            GROUP BY 1 ORDER BY "Sessions" DESC, "Clarity User ID" LIMIT 10
+        ''', self.filter_parameters(start_date, end_date, countries, devices))
+        user_metrics['Sessions'] = user_metrics['Sessions'].astype(int)
+        user_metrics['Time Spent'] = format_durations(user_metrics['Time Spent'])
+        return user_metrics
+
+    @instrumented("duckdb.new_users")
+    def new_users(self, start_date, end_date, countries, devices):
+        """Users first seen in the period, with their latest visit in the filtered rows"""
+        parameters = self.filter_parameters(start_date, end_date, countries, devices)
+        new_user_metrics = self.query(f'''
+            WITH new_users AS (
+                SELECT "Clarity user ID" FROM first_seen WHERE first_seen BETWEEN ? AND ?
+            )
+            SELECT "Clarity user ID" AS "Clarity User ID",
+                   arg_min("Country", row_id) AS "Country",
+                   arg_min("Device", row_id) AS "Device",
+                   arg_min("Referrer", row_id) AS "Referrer",
+                   MAX("Date") AS "Latest Visit Date",
+                   SUM("TotalSeconds") AS "Time Spent"
+            FROM sessions SEMI JOIN new_users USING ("Clarity user ID")
+            WHERE {self.FILTER}
+            GROUP BY 1 ORDER BY "Latest Visit Date" DESC, "Clarity User ID"
+        ''', parameters[:2] + parameters)
+        new_user_metrics['Time Spent'] = format_durations(new_user_metrics['Time Spent'])
+        return new_user_metrics
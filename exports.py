@@ -0,0 +1,79 @@
+"""Chunked CSV and Parquet exports of the filtered sessions and the section tables
+
+An export is written a chunk of rows at a time into a temporary file, which the dashboard hands
+to st.download_button as deferred data, so nothing is generated until a button is clicked. The
+filtered sessions are selected by row position in the shared frame: each chunk copies only its
+own rows, and no filtered copy of every session is made. The file is the only full-size artifact.
+"""
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from analytics_core import USER_CODE
+from instrumentation import span
+
+EXPORT_CHUNK_ROWS = 100_000
+
+# Export files larger than this are spooled to disk while being written
+SPOOL_MAX_BYTES = 16 * 1024 * 1024
+
+# File extension and MIME type of every export format
+EXPORT_FORMATS = {
+    "CSV": ("csv", "text/csv"),
+    "Parquet": ("parquet", "application/vnd.apache.parquet")
+}
+
+
+def filtered_positions(sessions, start_date, end_date, countries, devices):
+    """Row positions of the rows filter_sessions selects, without copying them"""
+    mask = ((sessions["Date"] >= pd.to_datetime(start_date)) &
+            (sessions["Date"] <= pd.to_datetime(end_date)) &
+            (sessions["Country"].isin(countries)) &
+            (sessions["Device"].isin(devices)))
+    return np.flatnonzero(mask.to_numpy())
+
+
+def iter_chunks(frame, positions=None, chunk_rows=EXPORT_CHUNK_ROWS):
+    """Consecutive chunks of the rows of frame at positions, or of every row
+
+    The dictionary's user codes are internal and left out. An empty selection yields one empty
+    chunk, so the file still gets its header.
+    """
+    columns = [position for position, column in enumerate(frame.columns) if column != USER_CODE]
+    if positions is None:
+        positions = np.arange(len(frame))
+    for start in range(0, max(len(positions), 1), chunk_rows):
+        yield frame.iloc[positions[start:start + chunk_rows], columns]
+
+
+def write_csv(chunks, file):
+    for index, chunk in enumerate(chunks):
+        file.write(chunk.to_csv(index=False, header=index == 0).encode())
+
+
+def write_parquet(chunks, file):
+    """Write every chunk as a row group, with the column types of the first one"""
+    writer = None
+    for chunk in chunks:
+        table = pa.Table.from_pandas(chunk, schema=writer.schema if writer else None, preserve_index=False)
+        if writer is None:
+            writer = pq.ParquetWriter(file, table.schema)
+        writer.write_table(table)
+    writer.close()
+
+
+def export_file(chunks, file_format):
+    """Temporary file holding the chunks in one of EXPORT_FORMATS, rewound for reading"""
+    writers = {"CSV": write_csv, "Parquet": write_parquet}
+    if file_format not in writers:
+        raise ValueError(f"Unknown export format {file_format!r}, expected one of {list(EXPORT_FORMATS)}")
+
+    file = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    with span("export", format=file_format) as record:
+        writers[file_format](chunks, file)
+        record['bytes'] = file.tell()
+    file.seek(0)
+    return file
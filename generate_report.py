@@ -0,0 +1,201 @@
+"""Batch report generator: compute the dashboard's Overview and User Insights outputs without Streamlit
+
+Examples:
+    python generate_report.py --input sessions.csv --range 2025-06-01:2025-06-30 --output-dir reports
+    python generate_report.py --store data/sessions --range 2025-06-01:2025-06-30
+    python generate_report.py --credentials service_account.json --range 2025-06-01:2025-06-30 \
+        --country India --device PC --format parquet
+"""
+import argparse
+import json
+import logging
+import os
+
+import pandas as pd
+
+import analytics_core as core
+from parallel_precompute import precompute_aggregates
+from partitioned_store import read_store
+
+logger = logging.getLogger("generate_report")
+
+
+def load_sessions(input_path=None, credentials_path=None, sources_path=None):
+    """Raw session rows from a CSV/Parquet export of the sheet or from the sheets themselves"""
+    if input_path is not None:
+        if input_path.endswith(".parquet"):
+            return pd.read_parquet(input_path)
+        return pd.read_csv(input_path)
+
+    sources = core.DEFAULT_SOURCES
+    if sources_path is not None:
+        with open(sources_path) as sources_file:
+            sources = json.load(sources_file)
+    with open(credentials_path) as credentials_file:
+        # Sources that fail to load are logged by load_sources and left out
+        df, _ = core.load_sources(json.load(credentials_file), sources)
+    return df
+
+
+def parse_range(value):
+    """START:END command line date range"""
+    try:
+        start_date, end_date = value.split(":")
+        return pd.to_datetime(start_date).date(), pd.to_datetime(end_date).date()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Expected a date range as START:END, got {value!r}")
+
+
+def build_report(df, backend, start_date, end_date, countries, devices, comparison_type, sketches,
+                 referrer_counts, first_seen=None):
+    """Every Overview and User Insights table of one date range and segment, keyed by table name
+
+    first_seen, a user_first_seen index of df maintained elsewhere, dates the cohorts.
+    """
+    filter_state = (start_date, end_date, countries, devices)
+
+    windows = core.get_comparison_windows(start_date, end_date, comparison_type)
+    kpis = backend.window_kpis(countries, devices, windows)
+    kpis.insert(0, 'Start', [window[1] for window in windows])
+    kpis.insert(1, 'End', [window[2] for window in windows])
+
+    tables = {
+        'kpis': kpis.rename_axis('Window').reset_index(),
+        'device_sessions': backend.sessions_by('Device', *filter_state).reset_index(name='Sessions'),
+        'os_sessions': backend.sessions_by('OS', *filter_state).reset_index(name='Sessions'),
+        'country_breakdown': backend.country_breakdown(*filter_state),
+        'percentiles': core.query_sketch_quantiles(sketches, *filter_state),
+        'percentiles_by_country': core.query_sketch_quantiles(sketches, *filter_state, by='Country'),
+        'percentiles_by_device': core.query_sketch_quantiles(sketches, *filter_state, by='Device'),
+        'daily_percentiles': core.query_sketch_quantiles(sketches, *filter_state, by='Date'),
+        'top_referrers': backend.top_referrers(*filter_state, referrer_counts=referrer_counts),
+        'top_users': backend.top_users(*filter_state),
+        'new_users': backend.new_users(*filter_state),
+        'daily_sessions': backend.sessions_by('Date', *filter_state).reset_index(name='Sessions'),
+        'weekday_sessions': backend.sessions_by('Weekday', *filter_state).reset_index(name='Sessions')
+    }
+    for granularity in ["Weekly", "Monthly"]:
+        retention = core.cohort_retention(df, granularity, countries, devices, start_date, end_date,
+                                          first_seen=first_seen)
+        tables[f'cohort_retention_{granularity.lower()}'] = retention.reset_index()
+    return tables
+
+
+def write_report(tables, metadata, directory, output_format):
+    """Write a report as one JSON document or as one Parquet file per table plus a metadata file"""
+    os.makedirs(directory, exist_ok=True)
+    for table in tables.values():
+        # Parquet needs string column names; cohort offsets are integers
+        table.columns = [str(column) for column in table.columns]
+
+    if output_format == "json":
+        report = dict(metadata)
+        report['tables'] = {
+            name: json.loads(table.to_json(orient="records", date_format="iso"))
+            for name, table in tables.items()
+        }
+        path = os.path.join(directory, "report.json")
+        with open(path, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+        return [path]
+
+    paths = []
+    for name, table in tables.items():
+        path = os.path.join(directory, f"{name}.parquet")
+        table.to_parquet(path, index=False)
+        paths.append(path)
+    metadata_path = os.path.join(directory, "metadata.json")
+    with open(metadata_path, "w") as metadata_file:
+        json.dump(metadata, metadata_file, indent=2)
+    return paths + [metadata_path]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compute the Gitforce analytics reports without the dashboard.")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--input", help="CSV or Parquet export of the 'Downloaded data' sheet")
+    source.add_argument("--credentials", help="Service account JSON used to read the sheets directly")
+    source.add_argument("--store", help="Month-partitioned session store filled by ingest_exports")
+    parser.add_argument("--sources", help="JSON list of {site, workbook, worksheet} sheets read with --credentials "
+                                          "(default: the Gitforce export)")
+    parser.add_argument("--site", dest="sites", action="append", help="Site to include, repeatable (default: all)")
+    parser.add_argument("--range", dest="ranges", action="append", type=parse_range, metavar="START:END",
+                        help="Date range to report on, repeatable (default: the full data range)")
+    parser.add_argument("--country", dest="countries", action="append",
+                        help="Country to include, repeatable (default: all)")
+    parser.add_argument("--device", dest="devices", action="append",
+                        help="Device to include, repeatable (default: all)")
+    parser.add_argument("--comparison", choices=core.COMPARISON_TYPES, default=core.COMPARISON_TYPES[0],
+                        help="Comparison period of the KPIs")
+    parser.add_argument("--backend", choices=core.BACKENDS, default="pandas",
+                        help="Engine for the section queries; duckdb runs them over a Parquet copy of the sessions, "
+                             "partitioned over a month-partitioned store")
+    parser.add_argument("--parquet-path", default="data/sessions.parquet",
+                        help="Parquet copy of the sessions used by the duckdb backend")
+    parser.add_argument("--store-path", default="data/sessions",
+                        help="Month-partitioned session store used by the partitioned backend")
+    parser.add_argument("--user-dictionary",
+                        help="SQLite user dictionary kept across runs, so users trimmed from the sheet stay returning")
+    parser.add_argument("--workers", type=int,
+                        help="Processes building the sketches and referrer counts (default: one per core)")
+    parser.add_argument("--format", dest="output_format", choices=["json", "parquet"], default="json")
+    parser.add_argument("--output-dir", default="reports")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    if args.store:
+        # The store holds preprocessed sessions of a single site
+        df = read_store(args.store).assign(Site=core.DEFAULT_SOURCES[0]["site"])
+    else:
+        df = load_sessions(args.input, args.credentials, args.sources)
+        if not df.empty:
+            df, _ = core.preprocess_sessions(df)
+    if df.empty:
+        parser.error("No session rows were loaded.")
+    if args.sites:
+        df = df[df["Site"].isin(args.sites)].reset_index(drop=True)
+        if df.empty:
+            parser.error(f"No session rows of the sites {args.sites}.")
+
+    countries = tuple(args.countries or sorted(df["Country"].unique()))
+    devices = tuple(args.devices or sorted(df["Device"].unique()))
+    ranges = args.ranges or [(df["Date"].min().date(), df["Date"].max().date())]
+
+    first_seen = backend_first_seen = None
+    if args.user_dictionary:
+        from user_dictionary import UserDictionary
+
+        dictionary = UserDictionary(args.user_dictionary)
+        logger.info("%d new user(s) added to %s", dictionary.update(df), args.user_dictionary)
+        df[core.USER_CODE] = dictionary.encode(df["Clarity user ID"])
+        # Users are dated by their first session on the selected sites
+        first_seen = dictionary.first_seen(by_code=True, sites=args.sites)
+        # Only the in-memory frame carries the codes; the stores look users up by ID
+        backend_first_seen = first_seen if args.backend == "pandas" else dictionary.first_seen(sites=args.sites)
+
+    # The backend and the mergeable aggregates are built once and answer every range
+    backend = core.make_backend(df, args.backend, args.parquet_path, args.store_path, backend_first_seen)
+    aggregates = precompute_aggregates(df, args.workers)
+    sketches = aggregates['sketches']
+    referrer_counts = aggregates['referrer_counts']
+
+    for start_date, end_date in ranges:
+        tables = build_report(df, backend, start_date, end_date, countries, devices, args.comparison, sketches,
+                              referrer_counts, first_seen)
+        metadata = {
+            'start_date': str(start_date),
+            'end_date': str(end_date),
+            'countries': list(countries),
+            'devices': list(devices),
+            'sites': sorted(df["Site"].unique()),
+            'comparison': args.comparison,
+            'data_version': core.dataset_version(df)
+        }
+        directory = os.path.join(args.output_dir, f"{start_date}_{end_date}")
+        paths = write_report(tables, metadata, directory, args.output_format)
+        logger.info("Wrote %d file(s) for %s to %s", len(paths), f"{start_date}..{end_date}", directory)
+
+
+if __name__ == "__main__":
+    main()
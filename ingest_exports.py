@@ -0,0 +1,214 @@
+"""Ingestion of raw Clarity CSV exports dropped into a directory
+
+New export files are streamed in chunks through the dashboard's preprocessing and appended to
+the month-partitioned session store as new part files, so memory stays bounded by the chunk
+size however large an export is. Exports usually overlap in time: every stored row carries a
+hash of its session fields and rows already in the store are skipped, which also makes it safe
+to ingest a file again after an interrupted run. Identical sessions within one export are
+indistinguishable from overlap and are kept once.
+
+Examples:
+    python ingest_exports.py --directory exports --store data/sessions --once
+    python ingest_exports.py --directory exports --store data/sessions --poll-seconds 30
+"""
+import argparse
+import glob
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+import analytics_core as core
+from duckdb_backend import SESSION_COLUMNS
+from instrumentation import span
+from partitioned_store import (FIRST_SEEN_FILE, INGEST_STATE_FILE, partition_files, read_partition, replace_parquet,
+                               stored_months)
+
+logger = logging.getLogger("ingest_exports")
+
+CHUNK_ROWS = 200_000
+
+# Months whose row hashes are kept in memory while ingesting; exports are mostly in date order
+CACHED_MONTHS = 6
+
+# Raw columns always read as text, so every chunk of an export gets the same types
+TEXT_COLUMNS = {"Date": str, "Clarity user ID": str, "Session duration": str}
+
+
+def session_hashes(sessions):
+    """64-bit hash of every session's fields, independent of whether counts or user IDs were read as numbers"""
+    fields = sessions[SESSION_COLUMNS].astype({"Page count": "float64", "Session clicks": "float64",
+                                                "TotalSeconds": "float64"})
+    # Parts written before IDs were normalised may hold the numeric IDs of the sheet
+    fields["Clarity user ID"] = core.normalize_user_ids(fields["Clarity user ID"])
+    return pd.util.hash_pandas_object(fields, index=False).to_numpy()
+
+
+def prepare_chunk(raw):
+    """Preprocess one chunk of raw export rows into the store's session columns"""
+    for column in ["Page count", "Session clicks"]:
+        if column in raw.columns:
+            raw[column] = pd.to_numeric(raw[column], errors="coerce")
+    sessions, messages = core.preprocess_sessions(raw)
+    return sessions[SESSION_COLUMNS].reset_index(drop=True), messages
+
+
+def load_ingest_state(store_path):
+    """Ingested files and the next row_id of a store; a store written from a frame continues its row_ids"""
+    path = os.path.join(store_path, INGEST_STATE_FILE)
+    if os.path.exists(path):
+        with open(path) as state_file:
+            return json.load(state_file)
+
+    next_row_id = 0
+    for month in stored_months(store_path):
+        next_row_id = max(next_row_id, int(read_partition(store_path, month, columns=['row_id'])['row_id'].max()) + 1)
+    return {'files': {}, 'next_row_id': next_row_id}
+
+
+def save_ingest_state(store_path, state):
+    temporary_path = os.path.join(store_path, INGEST_STATE_FILE + ".tmp")
+    with open(temporary_path, "w") as state_file:
+        json.dump(state, state_file, indent=2)
+    os.replace(temporary_path, os.path.join(store_path, INGEST_STATE_FILE))
+
+
+def file_signature(path):
+    """Size and modification time, which identify one version of an export file"""
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+class ExportIngester:
+    """Appends export files to a month-partitioned store, skipping sessions it already holds"""
+
+    def __init__(self, store_path, chunk_rows=CHUNK_ROWS, cached_months=CACHED_MONTHS):
+        self.store_path = store_path
+        self.chunk_rows = chunk_rows
+        self.cached_months = cached_months
+        os.makedirs(store_path, exist_ok=True)
+        self.state = load_ingest_state(store_path)
+        self._month_hashes = OrderedDict()
+
+    def month_hashes(self, month):
+        """Sorted hashes of the sessions stored for a month"""
+        if month in self._month_hashes:
+            self._month_hashes.move_to_end(month)
+            return self._month_hashes[month]
+
+        hashes = [np.empty(0, dtype="uint64")]
+        for path in partition_files(self.store_path, month):
+            if 'row_hash' in pq.read_schema(path).names:
+                hashes.append(pd.read_parquet(path, columns=['row_hash'])['row_hash'].to_numpy())
+            else:
+                # Parts written from a frame by write_partitioned_store carry no hashes yet
+                hashes.append(session_hashes(pd.read_parquet(path, columns=SESSION_COLUMNS)))
+        self._month_hashes[month] = np.unique(np.concatenate(hashes))
+        while len(self._month_hashes) > self.cached_months:
+            self._month_hashes.popitem(last=False)
+        return self._month_hashes[month]
+
+    def ingest_file(self, path):
+        """Append the new sessions of one export file, returning (rows read, rows appended)"""
+        tag = hashlib.sha1(os.path.basename(path).encode()).hexdigest()[:10]
+        rows_read = rows_appended = 0
+        first_seen = pd.Series(dtype="datetime64[ns]")
+
+        chunks = pd.read_csv(path, chunksize=self.chunk_rows, dtype=TEXT_COLUMNS)
+        for chunk_index, raw in enumerate(chunks):
+            with span("ingest.chunk", rows=len(raw), file=os.path.basename(path)):
+                rows_read += len(raw)
+                sessions, messages = prepare_chunk(raw)
+                for message in messages:
+                    logger.warning("%s: %s", path, message)
+
+                sessions['row_hash'] = session_hashes(sessions)
+                sessions = sessions[~sessions['row_hash'].duplicated()]
+                months = sessions['Date'].dt.strftime("%Y-%m")
+                for month, rows in sessions.groupby(months, sort=True):
+                    known = self.month_hashes(month)
+                    rows = rows[~np.isin(rows['row_hash'].to_numpy(), known)]
+                    if rows.empty:
+                        continue
+
+                    rows.insert(0, 'row_id', range(self.state['next_row_id'], self.state['next_row_id'] + len(rows)))
+                    self.state['next_row_id'] += len(rows)
+                    replace_parquet(rows, os.path.join(self.store_path, f"month={month}",
+                                                       f"part-{tag}-{chunk_index:05d}.parquet"))
+                    self._month_hashes[month] = np.union1d(known, rows['row_hash'].to_numpy())
+                    first_seen = pd.concat([first_seen, core.user_first_seen(rows)]).groupby(level=0).min()
+                    rows_appended += len(rows)
+                # Saved per chunk so a rerun after an interruption never reuses a written row_id
+                save_ingest_state(self.store_path, self.state)
+
+        self._update_first_seen(first_seen)
+        self.state['files'][os.path.basename(path)] = file_signature(path)
+        save_ingest_state(self.store_path, self.state)
+        logger.info("Ingested %s: %d row(s) read, %d appended", path, rows_read, rows_appended)
+        return rows_read, rows_appended
+
+    def _update_first_seen(self, first_seen):
+        """Fold the first sessions of newly appended rows into the store's first-seen index"""
+        if first_seen.empty:
+            return
+        path = os.path.join(self.store_path, FIRST_SEEN_FILE)
+        if os.path.exists(path):
+            stored = pd.read_parquet(path)
+            stored = stored.set_index(core.normalize_user_ids(stored["Clarity user ID"]))["first_seen"]
+            first_seen = pd.concat([stored, first_seen]).groupby(level=0).min()
+        replace_parquet(first_seen.rename_axis("Clarity user ID").reset_index(name="first_seen"), path)
+
+    def pending_files(self, directory, previous_signatures):
+        """Export files not yet ingested whose size and mtime were unchanged since the last poll
+
+        A file still being copied into the directory changes between polls and waits for the next one.
+        """
+        pending, signatures = [], {}
+        for path in sorted(glob.glob(os.path.join(directory, "*.csv"))):
+            signature = file_signature(path)
+            signatures[path] = signature
+            if self.state['files'].get(os.path.basename(path)) == signature:
+                continue
+            if previous_signatures.get(path) == signature:
+                pending.append(path)
+        return pending, signatures
+
+
+def watch(directory, store_path, poll_seconds=30, once=False, chunk_rows=CHUNK_ROWS):
+    """Ingest new export files of a directory as they arrive; once stops after the files present now"""
+    ingester = ExportIngester(store_path, chunk_rows)
+    signatures = {}
+    if once:
+        # No later poll will follow, so the files present now are taken as complete
+        _, signatures = ingester.pending_files(directory, {})
+    while True:
+        pending, signatures = ingester.pending_files(directory, signatures)
+        for path in pending:
+            ingester.ingest_file(path)
+        if once:
+            return
+        time.sleep(poll_seconds)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Ingest Clarity CSV exports dropped into a directory into the "
+                                                 "month-partitioned session store.")
+    parser.add_argument("--directory", required=True, help="Directory the exports are dropped into")
+    parser.add_argument("--store", default="data/sessions", help="Month-partitioned session store to append to")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS, help="Rows read and preprocessed at a time")
+    parser.add_argument("--poll-seconds", type=float, default=30)
+    parser.add_argument("--once", action="store_true", help="Ingest the files present now and exit")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    watch(args.directory, args.store, args.poll_seconds, args.once, args.chunk_rows)
+
+
+if __name__ == "__main__":
+    main()
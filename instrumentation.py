@@ -0,0 +1,117 @@
+"""Lightweight timing and memory spans around the dashboard's pipeline stages
+
+Every span records its wall time, the rows it processed and the change in process memory, is
+emitted as a one-line JSON log record and is kept in a bounded per-stage history, so p50/p95
+timings can be compared across reruns of a long-running server.
+
+The records are logged at INFO on the "gitforce.instrumentation" logger, which has no handler of
+its own: they go nowhere until the application configures logging or calls enable_logging().
+"""
+import functools
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger("gitforce.instrumentation")
+logger.addHandler(logging.NullHandler())
+
+# Spans kept per stage for the p50/p95 aggregates, and spans kept for the recent-activity view
+STAGE_HISTORY_SIZE = 200
+RECENT_SPANS_SIZE = 50
+
+_lock = threading.Lock()
+_stage_history = defaultdict(lambda: deque(maxlen=STAGE_HISTORY_SIZE))
+_recent_spans = deque(maxlen=RECENT_SPANS_SIZE)
+_log_handler = None
+
+
+def enable_logging(level=logging.INFO):
+    """Write every span record to stderr as a JSON line; safe to call again on every script run"""
+    global _log_handler
+    with _lock:
+        if _log_handler is None:
+            _log_handler = logging.StreamHandler()
+            _log_handler.setFormatter(logging.Formatter("%(message)s"))
+            logger.addHandler(_log_handler)
+            # The records are already complete lines, so handlers of the root logger must not repeat them
+            logger.propagate = False
+        logger.setLevel(level)
+
+
+def current_memory_mb():
+    """Resident memory of this process in MB, or its peak where the current value is unavailable"""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2 ** 20
+    except (OSError, ValueError):
+        import resource
+
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+        return peak / 2 ** 20 if sys.platform == "darwin" else peak / 1024
+
+
+@contextmanager
+def span(stage, rows=None, **fields):
+    """Time a block as one stage; the yielded record can be updated, e.g. with rows once known"""
+    record = {'stage': stage, 'rows': rows, **fields}
+    memory_before = current_memory_mb()
+    started = time.perf_counter()
+    try:
+        yield record
+    finally:
+        record['seconds'] = round(time.perf_counter() - started, 6)
+        record['memory_delta_mb'] = round(current_memory_mb() - memory_before, 3)
+        record['timestamp'] = time.time()
+        with _lock:
+            _stage_history[stage].append(record)
+            _recent_spans.append(record)
+        logger.info(json.dumps(record, default=str))
+
+
+def instrumented(stage):
+    """Decorator recording every call as a span; rows is the length of a leading frame or array argument"""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            rows = len(args[0]) if args and isinstance(args[0], (pd.DataFrame, pd.Series, np.ndarray)) else None
+            with span(stage, rows=rows):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def stage_summary():
+    """p50/p95 wall time per stage over its recent spans, slowest p95 first"""
+    with _lock:
+        history = {stage: list(records) for stage, records in _stage_history.items()}
+
+    summary = []
+    for stage, records in history.items():
+        seconds = np.array([record['seconds'] for record in records])
+        summary.append({
+            'Stage': stage,
+            'Runs': len(records),
+            'p50 (s)': float(np.percentile(seconds, 50)),
+            'p95 (s)': float(np.percentile(seconds, 95)),
+            'Last rows': records[-1]['rows'],
+            'Last memory delta (MB)': records[-1]['memory_delta_mb']
+        })
+    if not summary:
+        return pd.DataFrame()
+    return pd.DataFrame(summary).astype({'Last rows': 'Int64'}).sort_values('p95 (s)', ascending=False)
+
+
+def recent_spans():
+    """The most recent spans of any stage, newest first"""
+    with _lock:
+        records = list(_recent_spans)
+    return pd.DataFrame(records[::-1])
@@ -0,0 +1,143 @@
+"""Multi-core precomputation of the mergeable aggregates rebuilt after every data reload
+
+The quantile sketches and the referrer counts are both keyed by
+day, so the rows are sorted by date and cut into month partitions that never share a day. The
+encoded columns are placed in shared memory once; worker processes aggregate whole months from
+it without copying the rows, and their partial aggregates merge by concatenation.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, shared_memory
+
+import numpy as np
+import pandas as pd
+
+from analytics_core import sketch_buckets
+from instrumentation import instrumented, span
+
+# Text columns handed to the workers as integer codes into their sorted distinct values
+CODED_COLUMNS = ["Country", "Device", "Referrer"]
+
+# Below this many rows starting the worker processes costs more than it saves
+PARALLEL_MIN_ROWS = 200_000
+
+
+def encode_sessions(df):
+    """Numeric arrays of the columns the aggregates read, sorted by date, and the values behind each code"""
+    sessions = df.sort_values("Date", kind="stable")
+    arrays = {'Date': sessions["Date"].values}
+    categories = {}
+    for column in CODED_COLUMNS:
+        codes, categories[column] = pd.factorize(sessions[column], sort=True)
+        arrays[column] = codes.astype("int32")
+
+    pages = sessions["Page count"].to_numpy()
+    arrays['pages'] = pages if pages.dtype.kind in "iuf" else pages.astype("float64")
+    arrays['seconds'] = sessions["TotalSeconds"].to_numpy(dtype="float64")
+    arrays['duration_bucket'] = sketch_buckets(arrays['seconds'])
+    arrays['pages_bucket'] = sketch_buckets(arrays['pages'])
+    return arrays, categories
+
+
+def month_partitions(dates):
+    """(start, stop) row ranges of each calendar month in a sorted date array"""
+    months = dates.astype("datetime64[M]")
+    boundaries = np.flatnonzero(months[1:] != months[:-1]) + 1
+    edges = np.concatenate([[0], boundaries, [len(dates)]])
+    return list(zip(edges[:-1].tolist(), edges[1:].tolist()))
+
+
+def aggregate_rows(arrays, start, stop):
+    """Partial aggregates of one row range, with codes in place of the text columns"""
+    rows = pd.DataFrame({column: values[start:stop] for column, values in arrays.items()})
+    segment = ['Date', 'Country', 'Device']
+
+    sketches = []
+    for metric, column in [('duration', 'duration_bucket'), ('pages', 'pages_bucket')]:
+        metric_sketch = (rows[segment + [column]].rename(columns={column: 'bucket'})
+                         .groupby(segment + ['bucket']).size().reset_index(name='count'))
+        metric_sketch.insert(0, 'metric', metric)
+        sketches.append(metric_sketch)
+
+    return {
+        'sketches': pd.concat(sketches, ignore_index=True),
+        'referrer_counts': rows.groupby(segment + ['Referrer']).size().reset_index(name='Sessions')
+    }
+
+
+def _aggregate_shared(specs, start, stop):
+    """aggregate_rows in a worker process, over arrays attached from shared memory"""
+    blocks = {column: shared_memory.SharedMemory(name=name) for column, (name, _, _) in specs.items()}
+    try:
+        arrays = {column: np.ndarray(shape, dtype=dtype, buffer=blocks[column].buf)
+                  for column, (_, dtype, shape) in specs.items()}
+        partial = aggregate_rows(arrays, start, stop)
+        # The views must be gone before the blocks can be closed
+        del arrays
+        return partial
+    finally:
+        for block in blocks.values():
+            block.close()
+
+
+def _share_arrays(arrays):
+    """Copy arrays into new shared memory blocks, returning the blocks and how to attach to them"""
+    blocks, specs = [], {}
+    for column, values in arrays.items():
+        block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        blocks.append(block)
+        np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[:] = values
+        specs[column] = (block.name, values.dtype.str, values.shape)
+    return blocks, specs
+
+
+def _decode(frame, categories, columns):
+    """Replace the codes of the given columns by their values"""
+    for column in columns:
+        frame[column] = categories[column].take(frame[column].values)
+    return frame
+
+
+@instrumented("precompute_aggregates")
+def precompute_aggregates(df, workers=None):
+    """Quantile sketches and referrer counts of the sessions, built in parallel
+
+    Returns {'sketches', 'referrer_counts'}, matching build_quantile_sketches and build_referrer_counts.
+    workers defaults to the number of cores; small tables are aggregated in this process.
+    """
+    workers = workers or os.cpu_count() or 1
+    with span("precompute.encode", rows=len(df)):
+        arrays, categories = encode_sessions(df)
+    partitions = month_partitions(arrays['Date'])
+
+    if workers == 1 or len(partitions) == 1 or len(df) < PARALLEL_MIN_ROWS:
+        partials = [aggregate_rows(arrays, start, stop) for start, stop in partitions]
+    else:
+        blocks, specs = _share_arrays(arrays)
+        try:
+            # spawn rather than fork: the dashboard server is multi-threaded
+            with ProcessPoolExecutor(max_workers=min(workers, len(partitions)),
+                                     mp_context=get_context("spawn")) as pool:
+                partials = list(pool.map(_aggregate_shared, *zip(*[(specs, start, stop)
+                                                                   for start, stop in partitions])))
+        finally:
+            for block in blocks:
+                block.close()
+                block.unlink()
+
+    # Months never share a day, so the partial aggregates are disjoint and merge by concatenation
+    merged = {name: pd.concat([partial[name] for partial in partials], ignore_index=True) for name in partials[0]}
+
+    # Serial sketches list every duration bucket before the page count ones
+    sketches = merged['sketches'].sort_values('metric', kind="stable", ignore_index=True)
+    sketches = _decode(sketches, categories, ['Country', 'Device'])
+    referrer_counts = _decode(merged['referrer_counts'], categories, ['Country', 'Device', 'Referrer'])
+    for frame, columns in [(sketches, ['metric', 'Country', 'Device']),
+                           (referrer_counts, ['Country', 'Device', 'Referrer'])]:
+        for column in columns:
+            frame[column] = frame[column].astype('category')
+
+    return {
+        'sketches': sketches,
+        'referrer_counts': referrer_counts
+    }
@@ -0,0 +1,224 @@
+"""Month-partitioned session store: queries only read the months their date windows touch
+
+The preprocessed sessions are written as Parquet files per calendar month,
+store/month=YYYY-MM/part.parquet plus any part-*.parquet appended by ingest_exports, next to a
+small first_seen.parquet index holding every user's first session date. New and returning users
+need the full history only through that index, so a query over the last 30 days reads one or two
+month files instead of every session ever recorded.
+"""
+import glob
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+import analytics_core as core
+from duckdb_backend import SESSION_COLUMNS
+from instrumentation import instrumented, span
+
+FIRST_SEEN_FILE = "first_seen.parquet"
+# Files ingested into the store by ingest_exports and the next row_id to assign
+INGEST_STATE_FILE = "ingest_state.json"
+
+# Month partitions kept in memory between queries, least recently used first out
+CACHED_PARTITIONS = 24
+
+# Column types of the stored sessions, given to the frames of a store without any rows
+STORED_TYPES = {'row_id': "int64", 'Date': "datetime64[ns]", 'Clarity user ID': "str", 'Country': "str",
+                'Device': "str", 'OS': "str", 'Referrer': "str", 'Page count': "int64", 'Session clicks': "int64",
+                'TotalSeconds': "int64"}
+
+
+def partition_path(store_path, month):
+    """Parquet file of one 'YYYY-MM' month partition"""
+    return os.path.join(store_path, f"month={month}", "part.parquet")
+
+
+def partition_files(store_path, month):
+    """Every Parquet file of one 'YYYY-MM' month partition"""
+    return sorted(glob.glob(os.path.join(store_path, f"month={month}", "*.parquet")))
+
+
+def read_partition(store_path, month, columns=None):
+    """All rows of one month partition, in original row order"""
+    parts = [pd.read_parquet(path, columns=columns) for path in partition_files(store_path, month)]
+    rows = pd.concat(parts, ignore_index=True)
+    if len(parts) > 1:
+        rows = rows.sort_values('row_id', kind="stable", ignore_index=True)
+    if "Clarity user ID" in rows.columns:
+        # Parts written before IDs were normalised may hold the numeric IDs of the sheet
+        rows["Clarity user ID"] = core.normalize_user_ids(rows["Clarity user ID"])
+    return rows
+
+
+def empty_partition():
+    """A partition without rows, with the stored column types so the queries still see datetime dates"""
+    return pd.DataFrame({column: pd.Series(dtype=dtype) for column, dtype in STORED_TYPES.items()})
+
+
+def read_store(store_path):
+    """Every stored session as one frame, like the preprocessed sessions the store was built from"""
+    months = stored_months(store_path)
+    if not months:
+        return empty_partition()[SESSION_COLUMNS]
+    rows = pd.concat([read_partition(store_path, month) for month in months], ignore_index=True)
+    return rows.sort_values('row_id', kind="stable", ignore_index=True)[SESSION_COLUMNS]
+
+
+def partition_months(start_date, end_date):
+    """'YYYY-MM' labels of every month a date range touches"""
+    return list(pd.period_range(pd.to_datetime(start_date), pd.to_datetime(end_date), freq="M").strftime("%Y-%m"))
+
+
+def stored_months(store_path):
+    """'YYYY-MM' labels of the month partitions present in a store, oldest first"""
+    if not os.path.isdir(store_path):
+        return []
+    return sorted(name.split("=", 1)[1] for name in os.listdir(store_path) if name.startswith("month="))
+
+
+def replace_parquet(frame, path):
+    """Write a Parquet file through a temporary file, so readers never see a partial one"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = path + ".tmp"
+    frame.to_parquet(temporary_path, index=False)
+    os.replace(temporary_path, path)
+
+
+def rebuild_first_seen(store_path):
+    """First session date of every stored user, read from the partitions of a store without its index"""
+    users = [read_partition(store_path, month, columns=['row_id', 'Clarity user ID', 'Date'])
+             for month in stored_months(store_path)]
+    if not users:
+        return pd.Series(dtype="datetime64[ns]", index=pd.Index([], dtype="str", name="Clarity user ID"),
+                         name="first_seen")
+    return core.user_first_seen(pd.concat(users, ignore_index=True)).rename("first_seen")
+
+
+def is_ingested_store(store_path):
+    """Whether ingest_exports owns the store, which must then never be rewritten from a frame"""
+    return os.path.exists(os.path.join(store_path, INGEST_STATE_FILE))
+
+
+@instrumented("partitions.write")
+def write_partitioned_store(df, store_path, first_seen=None):
+    """Write the preprocessed sessions as month partitions plus the per-user first-seen index
+
+    row_id keeps the original row order, so per-user 'first' values match the in-memory frame.
+    first_seen, a user_first_seen index by user ID maintained elsewhere, is written as the index
+    in place of the first sessions of df. A store filled by ingest_exports is refused: rewriting
+    it would drop the ingested exports.
+    """
+    if is_ingested_store(store_path):
+        raise ValueError(f"{store_path} is filled by ingest_exports; open it with PartitionedBackend instead")
+    sessions = df[SESSION_COLUMNS].reset_index(drop=True)
+    sessions.insert(0, 'row_id', range(len(sessions)))
+    months = sessions["Date"].dt.strftime("%Y-%m")
+
+    for month, partition in sessions.groupby(months, sort=True):
+        replace_parquet(partition, partition_path(store_path, month))
+
+    # Months that no longer have rows would otherwise be read as stale data
+    written = set(months.unique())
+    for month in stored_months(store_path):
+        for path in partition_files(store_path, month):
+            if month not in written or path != partition_path(store_path, month):
+                os.remove(path)
+        if not partition_files(store_path, month):
+            os.rmdir(os.path.dirname(partition_path(store_path, month)))
+
+    if first_seen is None:
+        first_seen = core.user_first_seen(sessions)
+    first_seen = first_seen.rename_axis("Clarity user ID").reset_index(name="first_seen")
+    replace_parquet(first_seen, os.path.join(store_path, FIRST_SEEN_FILE))
+
+
+class PartitionedBackend:
+    """Section queries answered by the pandas functions on just the month partitions they touch"""
+
+    def __init__(self, store_path, cached_partitions=CACHED_PARTITIONS):
+        self.store_path = store_path
+        self.cached_partitions = cached_partitions
+        self.months = set(stored_months(store_path))
+        self._partitions = OrderedDict()
+        self._lock = threading.Lock()
+
+        first_seen_path = os.path.join(store_path, FIRST_SEEN_FILE)
+        if os.path.exists(first_seen_path):
+            first_seen = pd.read_parquet(first_seen_path)
+            self.first_seen = first_seen.set_index(core.normalize_user_ids(first_seen["Clarity user ID"]))["first_seen"]
+        else:
+            # A store copied without its index, or with no sessions yet; it is read-only here, so the
+            # index is rebuilt in memory rather than written
+            self.first_seen = rebuild_first_seen(store_path)
+
+    @classmethod
+    def from_frame(cls, df, store_path, cached_partitions=CACHED_PARTITIONS, first_seen=None):
+        """Backend over a freshly written store of a preprocessed session frame"""
+        write_partitioned_store(df, store_path, first_seen)
+        return cls(store_path, cached_partitions)
+
+    @classmethod
+    def open_or_write(cls, df, store_path, cached_partitions=CACHED_PARTITIONS, first_seen=None):
+        """Read-only backend over a store filled by ingest_exports, else one over a fresh store of df"""
+        if not is_ingested_store(store_path):
+            return cls.from_frame(df, store_path, cached_partitions, first_seen)
+
+        backend = cls(store_path, cached_partitions)
+        if first_seen is not None:
+            # Users may be known only to the exports or only to first_seen; each keeps its earliest date
+            backend.first_seen = pd.concat([backend.first_seen, first_seen]).groupby(level=0).min()
+        return backend
+
+    def partition(self, month):
+        """One month's rows, read from disk unless recently used"""
+        with self._lock:
+            if month in self._partitions:
+                self._partitions.move_to_end(month)
+                return self._partitions[month]
+
+        rows = read_partition(self.store_path, month)
+        with self._lock:
+            self._partitions[month] = rows
+            while len(self._partitions) > self.cached_partitions:
+                self._partitions.popitem(last=False)
+        return rows
+
+    def load(self, *date_ranges):
+        """Rows of every stored month touched by any of the (start, end) date ranges, in original row order"""
+        months = sorted({month for start_date, end_date in date_ranges
+                         for month in partition_months(start_date, end_date)} & self.months)
+        with span("partitions.load", partitions=len(months)) as record:
+            if not months:
+                # An empty frame with the stored dtypes, so the queries still see datetime dates
+                rows = self.partition(min(self.months)).head(0) if self.months else empty_partition()
+            else:
+                rows = pd.concat([self.partition(month) for month in months], ignore_index=True)
+                if len(months) > 1:
+                    rows = rows.sort_values('row_id', kind="stable", ignore_index=True)
+            record['rows'] = len(rows)
+        return rows
+
+    def window_kpis(self, countries, devices, windows):
+        rows = self.load(*[(window[1], window[2]) for window in windows])
+        return core.window_kpis(rows, countries, devices, windows, first_seen=self.first_seen)
+
+    def sessions_by(self, key, start_date, end_date, countries, devices):
+        return core.sessions_by(self.load((start_date, end_date)), key, start_date, end_date, countries, devices)
+
+    def country_breakdown(self, start_date, end_date, countries, devices):
+        return core.country_breakdown(self.load((start_date, end_date)), start_date, end_date, countries, devices,
+                                      first_seen=self.first_seen)
+
+    def top_referrers(self, start_date, end_date, countries, devices, top_k=15, referrer_counts=None):
+        """Top referrers ranked from the rows, since only the touched months are loaded anyway"""
+        rows = self.load((start_date, end_date))
+        return core.exact_top_referrers(core.filter_sessions(rows, start_date, end_date, countries, devices), top_k)
+
+    def top_users(self, start_date, end_date, countries, devices):
+        return core.top_users(self.load((start_date, end_date)), start_date, end_date, countries, devices)
+
+    def new_users(self, start_date, end_date, countries, devices):
+        return core.new_users(self.load((start_date, end_date)), start_date, end_date, countries, devices,
+                              first_seen=self.first_seen)
@@ -1,15 +1,21 @@
+import hashlib
 import os
+import time
+
 import pandas as pd
-import gspread
-from google.oauth2.service_account import Credentials
 import streamlit as st
-import plotly.express as px
-import plotly.graph_objects as go
 from datetime import timedelta
-from dateutil.relativedelta import relativedelta
-import re
-from urllib.parse import urlparse
-import json
+
+import analytics_core as core
+import instrumentation
+from change_detection import SourceMirror, make_probe, merge_mirrors, refresh_mirrors
+from exports import EXPORT_FORMATS, export_file, filtered_positions, iter_chunks
+from instrumentation import instrumented
+from analytics_core import (
+    COMPARISON_TYPES, EXACT_REFERRER_MAX_ROWS, MAX_CHART_POINTS, SKETCH_RELATIVE_ACCURACY, choose_time_granularity,
+    downsample_time_series, filter_sessions, format_duration, format_durations, get_comparison_windows, lttb_indices,
+    merge_referrer_counts, period_start, query_sketch_quantiles
+)
 
 # Set page config to make sidebar narrower
 st.set_page_config(
@@ -35,300 +41,527 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
-@st.cache_data
-def load_google_sheets_data():
-    """Load data from Google Sheets with credentials from Streamlit secrets"""
+# Every instrumented stage is logged to the server's stderr as one JSON line, next to the ?debug=1 panel
+instrumentation.enable_logging()
+
+
+# The sources are checked for changes at most this often unless [analytics] refresh_check_seconds
+# says otherwise; a check of an unchanged source is a single metadata request
+REFRESH_CHECK_SECONDS = 300
+
+
+@st.cache_resource(show_spinner=False)
+def source_mirrors():
+    """Mirrors of every site's source, kept for the life of the process and shared by all sessions"""
+    # Get credentials from Streamlit secrets; sources with a path are local CSV stand-ins
+    credentials_dict = dict(st.secrets.get("gcp_service_account", {}))
+    # Every [[analytics.sources]] entry is one site's export; all of them load concurrently
+    sources = [dict(source) for source in st.secrets.get("analytics", {}).get("sources", core.DEFAULT_SOURCES)]
+    if not sources:
+        raise ValueError("No sources are listed in [analytics] sources.")
+    return [SourceMirror(make_probe(source, credentials_dict), source["site"]) for source in sources]
+
+
+@st.cache_data(show_spinner=False, max_entries=1)
+def refresh_sources(check_interval):
+    """Refresh the mirrors once per check interval, returning the key of the rows they hold and warnings
+
+    check_interval numbers the current interval, so every session of an interval shares one refresh.
+    Unchanged sources are not downloaded again and appends only fetch the new rows.
+    """
+    mirrors = source_mirrors()
+    _, messages = refresh_mirrors(mirrors)
+    if all(mirror.state is None for mirror in mirrors):
+        # Nothing was ever loaded: raise, so the failure is not cached until the next interval
+        raise RuntimeError(messages[0])
+    return tuple((mirror.site, mirror.state and mirror.state['modified']) for mirror in mirrors), messages
+
+
+@st.cache_resource(show_spinner=False)
+def user_dictionary():
+    """Persistent user dictionary of [analytics] user_dictionary, or None when none is configured"""
+    path = st.secrets.get("analytics", {}).get("user_dictionary")
+    if path is None:
+        return None
+    from user_dictionary import UserDictionary
+
+    return UserDictionary(path)
+
+
+def encode_users(df):
+    """Record the users of a freshly loaded frame in the user dictionary, if any, and add their codes"""
+    dictionary = user_dictionary()
+    if dictionary is not None:
+        # Users whose rows were trimmed from the sheet keep their first session in the dictionary,
+        # and the sections index users by its integer codes
+        dictionary.update(df)
+        df[core.USER_CODE] = dictionary.encode(df["Clarity user ID"])
+
+
+@st.cache_resource(show_spinner=False, max_entries=1)
+def merge_sources(sources_key):
+    """Merge the mirrored sources once per change of any of them"""
+    mirrors = source_mirrors()
+    df = merge_mirrors(mirrors)
+    messages = [message for mirror in mirrors for message in mirror.messages]
+    if df.empty:
+        return df, 0, messages
+    encode_users(df)
+    return df, core.dataset_version(df), messages
+
+
+def ingested_store_path():
+    """store_path of the partitioned backend when ingest_exports fills it, otherwise None"""
+    analytics = st.secrets.get("analytics", {})
+    if analytics.get("backend") != "partitioned":
+        return None
+    from partitioned_store import is_ingested_store
+
+    store_path = analytics.get("store_path", "data/sessions")
+    return store_path if is_ingested_store(store_path) else None
+
+
+@st.cache_resource(show_spinner=False, max_entries=1)
+def load_ingested_store(store_path, state_modified):
+    """The sessions of an ingested store, read again whenever ingest_exports records another file"""
+    from partitioned_store import read_store
+
+    # The store holds preprocessed sessions of a single site
+    df = read_store(store_path).assign(Site=core.DEFAULT_SOURCES[0]["site"])
+    if df.empty:
+        return df, 0, []
+    df["Site"] = df["Site"].astype("category")
+    encode_users(df)
+    return df, core.dataset_version(df), []
+
+
+def load_shared_dataset():
+    """The preprocessed sessions of every source, refreshed when due; every session reads the same frame
+
+    The returned frame is shared by all viewers and must be treated as read-only: pages filter it
+    into new frames and per-session state only holds filter selections and small results. A store
+    that ingest_exports fills replaces the sheets, so every section reads the same sessions.
+    """
     try:
-        # Get credentials from Streamlit secrets
-        credentials_dict = {
-            "type": st.secrets["gcp_service_account"]["type"],
-            "project_id": st.secrets["gcp_service_account"]["project_id"],
-            "private_key_id": st.secrets["gcp_service_account"]["private_key_id"],
-            "private_key": st.secrets["gcp_service_account"]["private_key"],
-            "client_email": st.secrets["gcp_service_account"]["client_email"],
-            "client_id": st.secrets["gcp_service_account"]["client_id"],
-            "auth_uri": st.secrets["gcp_service_account"]["auth_uri"],
-            "token_uri": st.secrets["gcp_service_account"]["token_uri"],
-            "auth_provider_x509_cert_url": st.secrets["gcp_service_account"]["auth_provider_x509_cert_url"],
-            "client_x509_cert_url": st.secrets["gcp_service_account"]["client_x509_cert_url"]
-        }
-        
-        scope = [
-            "https://spreadsheets.google.com/feeds",
-            "https://www.googleapis.com/auth/spreadsheets",
-            "https://www.googleapis.com/auth/drive"
-        ]
-        
-        creds = Credentials.from_service_account_info(credentials_dict, scopes=scope)
-        client = gspread.authorize(creds)
-        
-        workbook = client.open("Clarity Data")
-        worksheet = workbook.worksheet("Downloaded data")
-        data = worksheet.get_all_records()
-        
-        return pd.DataFrame(data)
-        
+        store_path = ingested_store_path()
+        if store_path is not None:
+            from partitioned_store import INGEST_STATE_FILE
+
+            state_modified = os.path.getmtime(os.path.join(store_path, INGEST_STATE_FILE))
+            return load_ingested_store(store_path, state_modified)
+    except Exception as e:
+        st.error(f"Error loading the session store: {str(e)}")
+        return pd.DataFrame(), 0, []
+
+    try:
+        # Secrets are read here rather than at import, so bad ones are reported below the page shell
+        check_seconds = float(st.secrets.get("analytics", {}).get("refresh_check_seconds", REFRESH_CHECK_SECONDS))
+        sources_key, refresh_messages = refresh_sources(int(time.time() // check_seconds))
     except Exception as e:
         st.error(f"Error loading data from Google Sheets: {str(e)}")
         st.info("Please check your Google Sheets credentials in Streamlit secrets.")
-        return pd.DataFrame()
+        return pd.DataFrame(), 0, []
 
-# Load data
-df = load_google_sheets_data()
+    df, data_version, messages = merge_sources(sources_key)
+    return df, data_version, refresh_messages + messages
 
-# Only proceed if data is loaded successfully
-if not df.empty:
-    # Data preprocessing
-    df["Date"] = pd.to_datetime(df["Date"], dayfirst=True, errors='coerce')
-    df = df[df["Date"].notnull()]
-    df = df[df["Clarity user ID"].notnull()]
-    df["Device"] = df["Device"].fillna("Unknown")
-    df["Country"] = df["Country"].fillna("Unknown")
-
-    # Handle OS column
-    if "OS" not in df.columns:
-        df["OS"] = "Unknown"
-    else:
-        df["OS"] = df["OS"].fillna("Unknown")
-
-    # Handle Referrer column (IMPROVED VERSION)
-    def clean_referrer(referrer):
-        """Clean and standardize referrer data"""
-        # Convert to string first
-        referrer_str = str(referrer).strip()
-        
-        # Handle various representations of empty/null values
-        if (referrer_str in ['', 'nan', 'None', 'null', 'NaN'] or 
-            pd.isna(referrer) or 
-            referrer is None or 
-            referrer_str.lower() == 'none'):
-            return "Direct"
-        
-        # If it's a full URL, extract the domain
-        if referrer_str.startswith(('http://', 'https://')):
-            try:
-                parsed = urlparse(referrer_str)
-                domain = parsed.netloc.lower()
-                # Remove www. prefix for cleaner display
-                if domain.startswith('www.'):
-                    domain = domain[4:]
-                return domain if domain else "Direct"
-            except:
-                return "Direct"
-        
-        # If it's already a clean domain or other referrer type, return as is
-        return referrer_str
-
-    # Apply the cleaning func
-    if "Referrer" not in df.columns:
-        df["Referrer"] = "Direct"
-    else:
-        df["Referrer"] = df["Referrer"].apply(clean_referrer)
 
-        
+# Page shell: the page selector and title are drawn before the data arrives, so the first paint
+# does not wait for the Sheets load
+PAGE_TITLES = {
+    "Overview": "Gitforce Website Analytics - Overview",
+    "User Insights": "Gitforce Website Analytics - User Insights"
+}
+page = st.sidebar.selectbox("Select Page", list(PAGE_TITLES))
+st.title(PAGE_TITLES[page])
+filters_placeholder = st.sidebar.empty()
+filters_placeholder.caption("Loading filters...")
 
-    # Handle Page count column
-    if 'Page count' not in df.columns:
-        st.warning("Page count column not found. Using default value of 1.")
-        df['Page count'] = 1
-
-    # Handle Clicks column (if it exists)
-    if 'Session clicks' not in df.columns:
-        df['Session clicks'] = 0
-    else:
-        df['Session clicks'] = df['Session clicks'].fillna(0)
-
-    def duration_to_seconds(duration_str):
-        if pd.isna(duration_str) or duration_str == "":
-            return 0
-
-        duration_str = str(duration_str).strip()
-        colon_count = duration_str.count(':')
-
-        try:
-            if colon_count == 1:  # mm:ss format
-                parts = duration_str.split(':')
-                minutes = int(parts[0])
-                seconds = int(parts[1])
-                return (minutes * 60) + seconds
-            elif colon_count == 2:  # hh:mm:ss format
-                parts = duration_str.split(':')
-                hours = int(parts[0])
-                minutes = int(parts[1])
-                seconds = int(parts[2])
-                return (hours * 3600) + (minutes * 60) + seconds
-            else:
-                return 0
-        except:
-            return 0
-
-    if 'Session duration' in df.columns:
-        df['TotalSeconds'] = df['Session duration'].apply(duration_to_seconds)
-    else:
-        st.warning("Session duration column not found. Using default value of 0.")
-        df['TotalSeconds'] = 0
-
-    # Page Selection
-    page = st.sidebar.selectbox("Select Page", ["Overview", "User Insights"])
+# Load data
+with st.spinner("Loading analytics data..."):
+    df, data_version, preprocessing_messages = load_shared_dataset()
+filters_placeholder.empty()
 
-    # Common Filters for User Insights page
-    if page == "User Insights":
+# Only proceed if data is loaded successfully
+if not df.empty:
+    for message in preprocessing_messages:
+        st.warning(message)
+
+    # Diagnostics such as table payload sizes are shown when the app is opened with ?debug=1
+    DEBUG_MODE = st.query_params.get("debug") == "1"
+
+    def clamp_filter_state(min_date, max_date, all_countries, all_devices):
+        """Fit the committed filter state to the loaded data, so no filter widget gets a value outside its options
+
+        The stored selections were made against earlier data: switching sites or a refresh that drops
+        old rows can narrow the dates and options, and date_input raises on a value past its bounds.
+        """
+        st.session_state.setdefault("filter_date_range", (min_date, max_date))
+        st.session_state.setdefault("filter_countries", all_countries)
+        st.session_state.setdefault("filter_devices", all_devices)
+
+        # Intersect the range, or the start of one being picked, with the loaded dates; a range that
+        # no longer overlaps them is reset to all of them
+        date_range = tuple(st.session_state["filter_date_range"]) or (min_date, max_date)
+        clamped = (max(date_range[0], min_date),) + tuple(min(day, max_date) for day in date_range[1:])
+        if clamped[0] > min(clamped[-1], max_date):
+            clamped = (min_date, max_date)
+        st.session_state["filter_date_range"] = clamped
+
+        # Drop selections that no longer exist in the loaded data
+        for key, options in [("filter_countries", all_countries), ("filter_devices", all_devices)]:
+            st.session_state[key] = [value for value in st.session_state[key] if value in options]
+
+    def apply_filter_preset(preset, top_countries, filter_options):
+        """Sidebar preset callback: update the committed filter state in one step"""
+        if preset == "Top 5 countries":
+            st.session_state["filter_countries"] = top_countries
+        else:
+            days = int(preset.split()[1])
+            max_date = filter_options[1]
+            st.session_state["filter_date_range"] = (max_date - timedelta(days=days - 1), max_date)
+        clamp_filter_state(*filter_options)
+
+    def render_sidebar_filters(page):
+        """Sidebar filters shared by both pages
+
+        In batched mode the filters sit in a form and are committed together with Apply, so editing
+        several of them costs one recompute instead of one per change. Returns the filter state and
+        the comparison type chosen in the form, or None when the KPI section should offer its own.
+        """
         st.sidebar.title("Filters")
 
-        # Date Range
-        min_date = df["Date"].min()
-        max_date = df["Date"].max()
-        start_date, end_date = st.sidebar.date_input("Select date range", [min_date, max_date],
-                                                     min_value=min_date, max_value=max_date)
-
-        # Country Filter
+        min_date = df["Date"].min().date()
+        max_date = df["Date"].max().date()
         all_countries = sorted(df["Country"].unique())
-        selected_countries = st.sidebar.multiselect("Select Country", all_countries, default=all_countries)
-
-        # Device Filter
         all_devices = sorted(df["Device"].unique())
-        selected_devices = st.sidebar.multiselect("Select Device", all_devices, default=all_devices)
-
-    def format_duration(total_seconds):
-        if total_seconds == 0:
-            return "-"
-
-        hours = int(total_seconds // 3600)
-        minutes = int((total_seconds % 3600) // 60)
-        seconds = int(total_seconds % 60)
-
-        if hours > 0:
-            return f"{hours}h{minutes}m"
-        elif minutes > 0:
-            return f"{minutes}m{seconds}s"
-        else:
-            return f"{seconds}s"
-
-    def get_comparison_dates(start_date, end_date, comparison_type):
-        """Fixed comparison date calculation"""
-        start_date = pd.to_datetime(start_date)
-        end_date = pd.to_datetime(end_date)
-
-        # Calculate the number of days in the selected period (inclusive)
-        period_length = (end_date - start_date).days + 1
-
-        if comparison_type == "Last Trailing Period":
-            # For trailing period: go back by the same number of days
-            # If current period is June 1-10 (10 days), trailing period should be May 22-31 (10 days)
-            comp_end_date = start_date - timedelta(days=1)  # Day before start date
-            comp_start_date = comp_end_date - timedelta(days=period_length - 1)  # Go back period_length days
-
-        else:  # Same Period Last Month
-            # For same period last month: same dates but previous month
-            # If current period is June 1-10, comparison period is May 1-10
-            try:
-                # Use relativedelta for proper month arithmetic
-                comp_start_date = start_date - relativedelta(months=1)
-                comp_end_date = end_date - relativedelta(months=1)
-            except:
-                # Fallback to simple subtraction if relativedelta fails
-                if start_date.month == 1:
-                    comp_start_date = start_date.replace(year=start_date.year - 1, month=12)
-                    comp_end_date = end_date.replace(year=end_date.year - 1, month=12)
+        filter_options = (min_date, max_date, all_countries, all_devices)
+
+        # The committed filter state is fitted to the data on every run; widgets read and write it through their keys
+        clamp_filter_state(*filter_options)
+        st.session_state.setdefault("filter_comparison", COMPARISON_TYPES[0])
+
+        # Quick presets
+        top_countries = df["Country"].value_counts().head(5).index.tolist()
+        preset_cols = st.sidebar.columns(2)
+        for i, preset in enumerate(["Last 7 days", "Last 30 days", "Last 90 days", "Top 5 countries"]):
+            preset_cols[i % 2].button(preset, on_click=apply_filter_preset,
+                                      args=(preset, top_countries, filter_options), use_container_width=True)
+
+        batched = st.sidebar.toggle("Batch filter changes", key="filter_batched",
+                                    help="Edit several filters and apply them together")
+        container = st.sidebar.form("filter_form") if batched else st.sidebar.container()
+
+        with container:
+            # Date Range
+            date_range = st.date_input("Select date range", key="filter_date_range", min_value=min_date,
+                                       max_value=max_date)
+
+            # Country Filter
+            selected_countries = st.multiselect("Select Country", all_countries, key="filter_countries")
+
+            # Device Filter
+            selected_devices = st.multiselect("Select Device", all_devices, key="filter_devices")
+
+            # Comparison Filter, committed with the other filters in batched mode
+            comparison_type = None
+            if batched and page == "Overview":
+                comparison_type = st.selectbox("Comparison Period", COMPARISON_TYPES, key="filter_comparison")
+
+            if batched:
+                st.form_submit_button("Apply", type="primary", use_container_width=True)
+
+        # A range is only usable once both ends are picked
+        if len(date_range) != 2:
+            st.info("Select the end of the date range.")
+            st.stop()
+
+        start_date, end_date = date_range
+        return start_date, end_date, selected_countries, selected_devices, comparison_type
+
+    @st.cache_resource(show_spinner=False, max_entries=4)
+    def site_view(_df, data_version, sites):
+        """Rows of the selected sites and their data version, shared by all sessions viewing those sites"""
+        site_df = _df[_df["Site"].isin(sites)].reset_index(drop=True)
+        return site_df, core.dataset_version(site_df)
+
+    # Site filter, shown when several sites' exports are loaded. A partial selection replaces the
+    # shared frame by a cached view of the selected sites, so every section below is scoped to them.
+    all_sites = sorted(df["Site"].unique())
+    SITE_SCOPE = VIEW_SITES = None
+    if len(all_sites) > 1:
+        st.session_state.setdefault("filter_sites", all_sites)
+        st.session_state["filter_sites"] = [site for site in st.session_state["filter_sites"] if site in all_sites]
+        selected_sites = st.sidebar.multiselect("Select Site", all_sites, key="filter_sites")
+        if not selected_sites:
+            st.info("Select at least one site.")
+            st.stop()
+        if len(selected_sites) < len(all_sites):
+            sites = tuple(sorted(selected_sites))
+            df, data_version = site_view(df, data_version, sites)
+            SITE_SCOPE = hashlib.sha1("|".join(sites).encode()).hexdigest()[:8]
+            VIEW_SITES = sites
+
+    # Common Filters for both pages
+    start_date, end_date, selected_countries, selected_devices, comparison_type = render_sidebar_filters(page)
+
+    def slim_table(table, columns):
+        """Copy of a table with only the displayed columns, in the most compact types Arrow can send
+
+        Repetitive strings become dictionary-encoded categoricals, timestamps become plain dates and
+        numbers are downcast to the smallest type that holds them.
+        """
+        table = table[[column for column in columns if column in table.columns]].copy()
+        for column in table.columns:
+            values = table[column]
+            if pd.api.types.is_datetime64_any_dtype(values):
+                table[column] = values.dt.date
+            elif pd.api.types.is_bool_dtype(values):
+                continue
+            elif pd.api.types.is_integer_dtype(values):
+                table[column] = pd.to_numeric(values, downcast="integer")
+            elif pd.api.types.is_float_dtype(values):
+                if values.notna().all() and (values % 1 == 0).all():
+                    table[column] = pd.to_numeric(values.astype("int64"), downcast="integer")
                 else:
-                    comp_start_date = start_date.replace(month=start_date.month - 1)
-                    comp_end_date = end_date.replace(month=end_date.month - 1)
-
-        return comp_start_date, comp_end_date
-
-    def calculate_kpis(filtered_df, df_all, period_start=None, period_end=None):
-        """Calculate all KPIs for a given filtered dataframe"""
-        kpis = {}
-
-        if len(filtered_df) == 0:
-            # Return zero values if no data
-            return {
-                'unique_users': 0,
-                'new_users': 0,
-                'total_sessions': 0,
-                'returning_users': 0,
-                'avg_duration': 0,
-                'avg_duration_formatted': '-',
-                'page_views': 0,
-                'bounce_rate': 0
-            }
-
-        # Use provided period dates or fall back to actual data range
-        if period_start is not None and period_end is not None:
-            filter_start = pd.to_datetime(period_start)
-            filter_end = pd.to_datetime(period_end)
-        else:
-            filter_start = filtered_df["Date"].min()
-            filter_end = filtered_df["Date"].max()
-
-        # 1. Unique Users
-        kpis['unique_users'] = filtered_df["Clarity user ID"].nunique()
-
-        # 2. New Users - users whose first appearance is within the filtered period
-        first_seen_dates = df_all.groupby("Clarity user ID")["Date"].min().reset_index(name="first_seen")
-
-        # Find users who first appeared in this period
-        new_users_in_period = first_seen_dates[
-            (first_seen_dates["first_seen"] >= filter_start) &
-            (first_seen_dates["first_seen"] <= filter_end)
-            ]
-
-        # Count how many of these new users are in our filtered data
-        kpis['new_users'] = filtered_df[
-            filtered_df["Clarity user ID"].isin(new_users_in_period["Clarity user ID"])
-        ]["Clarity user ID"].nunique()
-
-        # 3. Total Sessions
-        kpis['total_sessions'] = len(filtered_df)
-
-        # 4. Returning Users
-        # Count sessions per user in the filtered period
-        user_sessions = filtered_df.groupby("Clarity user ID").size().reset_index(name="session_count")
-
-        # New users with multiple sessions in the current period
-        new_returning = user_sessions[user_sessions["session_count"] > 1]["Clarity user ID"].nunique()
-
-        # Existing users (first seen before filter period) who are active in the period
-        existing_users = first_seen_dates[first_seen_dates["first_seen"] < filter_start]["Clarity user ID"]
-        existing_returning = filtered_df[
-            filtered_df["Clarity user ID"].isin(existing_users)
-        ]["Clarity user ID"].nunique()
-
-        kpis['returning_users'] = new_returning + existing_returning
-
-        # 5. Average Session Duration
-        avg_duration_seconds = filtered_df['TotalSeconds'].mean()
-        kpis['avg_duration'] = avg_duration_seconds
-        kpis['avg_duration_formatted'] = format_duration(avg_duration_seconds)
-
-        # 6. Page Views
-        kpis['page_views'] = filtered_df['Page count'].sum()
+                    table[column] = values.astype("float32")
+            elif isinstance(values.dtype, pd.CategoricalDtype):
+                table[column] = values.cat.remove_unused_categories()
+            elif len(values) >= 100 and values.nunique() <= len(values) // 2:
+                # Dictionary encoding only pays for its dictionary on longer tables
+                table[column] = values.astype("category")
+        return table
+
+    def arrow_payload_size(table):
+        """Size in bytes of a table serialized as the Arrow IPC stream st.dataframe sends"""
+        import pyarrow as pa
+
+        arrow_table = pa.Table.from_pandas(table, preserve_index=False)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, arrow_table.schema) as writer:
+            writer.write_table(arrow_table)
+        return sink.getvalue().size
+
+    def render_table(table, column_config):
+        """st.dataframe of the configured columns only, slimmed before serialization"""
+        slim = slim_table(table, column_config.keys())
+        st.dataframe(
+            slim,
+            use_container_width=True,
+            hide_index=True,
+            column_config=column_config
+        )
+        if DEBUG_MODE:
+            st.caption(f"Table payload: {arrow_payload_size(slim):,} bytes "
+                       f"(unslimmed: {arrow_payload_size(table):,} bytes)")
+
+    def render_downloads(name, chunks):
+        """A download button per export format; chunks() yields the rows, and only runs on a click
+
+        The file is written chunk by chunk on Streamlit's download thread, and clicking does not rerun the page.
+        Callable data needs Streamlit 1.52, below the 1.55 that requirements.txt asks for the tabs.
+        """
+        for column, (file_format, (extension, mime)) in zip(st.columns(len(EXPORT_FORMATS)), EXPORT_FORMATS.items()):
+            column.download_button(file_format, lambda file_format=file_format: export_file(chunks(), file_format),
+                                   file_name=f"{name}.{extension}", mime=mime, key=f"download_{name}_{extension}",
+                                   on_click="ignore", use_container_width=True)
+
+    # Download of the filtered sessions, selected by row position so no filtered copy is kept
+    with st.sidebar.expander("Download filtered sessions"):
+        export_filters = (start_date, end_date, tuple(selected_countries), tuple(selected_devices))
+        render_downloads(f"sessions_{start_date}_{end_date}",
+                         lambda: iter_chunks(df, filtered_positions(df, *export_filters)))
+
+    @st.cache_data(show_spinner=False, max_entries=32)
+    def compute_cohort_retention(_df, data_version, granularity, countries, devices, start_date, end_date,
+                                 max_offset=12):
+        """Acquisition cohort retention matrix of the selected countries and devices"""
+        dictionary = user_dictionary()
+        first_seen = dictionary.first_seen(by_code=True, sites=VIEW_SITES) if dictionary is not None else None
+        return core.cohort_retention(_df, granularity, countries, devices, start_date, end_date, max_offset,
+                                     first_seen)
+
+    # Tuning of the analytics engine from the [analytics] secrets; every key is optional
+    ANALYTICS_CONFIG = st.secrets.get("analytics", {})
+
+    def scoped_path(path):
+        """A configured file path, suffixed per site selection so different site views never share files"""
+        if SITE_SCOPE is None:
+            return path
+        root, extension = os.path.splitext(path)
+        return f"{root}-{SITE_SCOPE}{extension}"
+
+    @st.cache_resource(show_spinner=False, max_entries=2)
+    def precompute_aggregates(_df, data_version):
+        """Quantile sketches and referrer counts, built across worker processes"""
+        import parallel_precompute
+
+        return parallel_precompute.precompute_aggregates(_df, ANALYTICS_CONFIG.get("precompute_workers"))
+
+    @st.cache_resource(show_spinner=False, max_entries=2)
+    def load_aggregate_store(_df, data_version):
+        """SQLite aggregate store of [analytics] aggregate_store, brought up to date with the dataset"""
+        from aggregate_store import AggregateStore
+
+        store = AggregateStore(scoped_path(ANALYTICS_CONFIG["aggregate_store"]))
+        store.update(_df)
+        return store
+
+    def build_quantile_sketches(_df, data_version):
+        """Mergeable quantile sketches of the dataset, shared by all sessions"""
+        return precompute_aggregates(_df, data_version)['sketches']
+
+    def build_referrer_counts(_df, data_version):
+        """Per-day referrer session counts of the dataset, shared by all sessions"""
+        return precompute_aggregates(_df, data_version)['referrer_counts']
+
+    def render_sparkline(values, color="#1f77b4", width=120, height=28):
+        """Render a list of values as a small inline SVG trend line"""
+        values = [float(v) for v in values]
+        if len(values) < 2:
+            return ""
+
+        low, high = min(values), max(values)
+        spread = (high - low) or 1
+        step = width / (len(values) - 1)
+        points = " ".join(
+            f"{i * step:.1f},{height - 2 - (v - low) / spread * (height - 4):.1f}"
+            for i, v in enumerate(values)
+        )
+        return (f'<svg width="{width}" height="{height}" style="display: block; margin-top: 6px;">'
+                f'<polyline points="{points}" fill="none" stroke="{color}" stroke-width="2"/></svg>')
+
+    # Figures are cached on their aggregated input and options, so a rerun that leaves a chart's
+    # data unchanged reuses the stored figure instead of rebuilding it with plotly express
+    @st.cache_data(show_spinner=False, max_entries=64)
+    @instrumented("figure.pie")
+    def build_pie_figure(data, values, names, palette):
+        """Donut chart of a session breakdown"""
+        import plotly.express as px
+
+        fig = px.pie(
+            data,
+            values=values,
+            names=names,
+            hole=0.4,
+            color_discrete_sequence=getattr(px.colors.qualitative, palette)
+        )
+        fig.update_traces(textposition='inside', textinfo='percent+label')
+        fig.update_layout(
+            showlegend=True,
+            height=400,
+            margin=dict(t=0, b=0, l=0, r=0)
+        )
+        return fig
+
+    @st.cache_data(show_spinner=False, max_entries=64)
+    @instrumented("figure.line")
+    def build_line_figure(data, x, y, title, xaxis_title, yaxis_title, markers=True, legend_title=None, color=None):
+        """Line chart of one or more series over x, given as wide columns or as long rows split by color"""
+        import plotly.express as px
+
+        fig = px.line(
+            data,
+            x=x,
+            y=y,
+            color=color,
+            title=title,
+            markers=markers
+        )
+        fig.update_layout(
+            height=400,
+            xaxis_title=xaxis_title,
+            yaxis_title=yaxis_title,
+            hovermode='x unified'
+        )
+        if legend_title is not None:
+            fig.update_layout(legend_title_text=legend_title)
+        return fig
+
+    @st.cache_data(show_spinner=False, max_entries=64)
+    @instrumented("figure.referrer")
+    def build_referrer_figure(chart_data):
+        """Horizontal bar chart of top referrers"""
+        import plotly.express as px
+
+        fig = px.bar(
+            chart_data,
+            x='Sessions',
+            y='Referrer',
+            orientation='h',
+            color='Sessions',
+            color_continuous_scale='viridis',
+            text='Sessions',
+            title=f'Top {len(chart_data)} Referrers by Session Count'
+        )
 
-        # 7. Bounce Rate
-        user_page_counts = filtered_df.groupby("Clarity user ID")['Page count'].sum().reset_index()
-        users_with_one_page = len(user_page_counts[user_page_counts['Page count'] == 1])
-        total_unique_users = kpis['unique_users']
-        kpis['bounce_rate'] = (users_with_one_page / total_unique_users) * 100 if total_unique_users > 0 else 0
+        # Update layout for better readability
+        fig.update_traces(
+            textposition='outside',
+            texttemplate='%{text}',
+            hovertemplate='<b>%{y}</b><br>Sessions: %{x}<extra></extra>'
+        )
 
-        return kpis
+        fig.update_layout(
+            height=max(500, len(chart_data) * 35),  # Dynamic height
+            showlegend=False,
+            xaxis_title="Number of Sessions",
+            yaxis_title="Referrer Source",
+            coloraxis_showscale=False,
+            margin=dict(l=200, r=100, t=80, b=50),  # Adjusted margins
+            font=dict(size=12),
+            title_x=0.5,  # Center the title
+            yaxis=dict(
+                tickmode='linear',
+                automargin=True
+            )
+        )
+        return fig
+
+    @st.cache_data(show_spinner=False, max_entries=16)
+    @instrumented("figure.cohort")
+    def build_cohort_figure(retention_pct, cohort_labels, xaxis_title):
+        """Heatmap of cohort retention percentages"""
+        import plotly.express as px
+
+        fig = px.imshow(
+            retention_pct.values,
+            x=retention_pct.columns,
+            y=cohort_labels,
+            color_continuous_scale='Blues',
+            zmin=0,
+            zmax=100,
+            text_auto='.0f',
+            aspect='auto'
+        )
+        fig.update_layout(
+            height=max(400, len(cohort_labels) * 28),
+            xaxis_title=xaxis_title,
+            yaxis_title="Cohort (users)",
+            coloraxis_colorbar=dict(title="Retained %")
+        )
+        return fig
 
-    def display_comparison_metric(label, current_value, comparison_value, format_type="number"):
-        """Display metric with comparison"""
-        if comparison_value == 0:
-            change_pct = 0
-        else:
-            change_pct = ((current_value - comparison_value) / comparison_value) * 100
+    def display_comparison_metric(label, current_value, comparison_value, format_type="number", trend=None,
+                                  extra_comparisons=None):
+        """Display metric with comparison, an optional trend sparkline and extra reference values"""
+        def change_against(reference_value):
+            if reference_value == 0:
+                return 0
+            return ((current_value - reference_value) / reference_value) * 100
 
         # Format values based on type
-        if format_type == "duration":
-            current_display = format_duration(current_value)
-            comparison_display = format_duration(comparison_value)
-        elif format_type == "percentage":
-            current_display = f"{current_value:.1f}%"
-            comparison_display = f"{comparison_value:.1f}%"
-        else:
-            current_display = f"{current_value:,}"
-            comparison_display = f"{comparison_value:,}"
+        def format_value(value):
+            if format_type == "duration":
+                return format_duration(value)
+            elif format_type == "percentage":
+                return f"{value:.1f}%"
+            else:
+                return f"{value:,}"
+
+        change_pct = change_against(comparison_value)
+        current_display = format_value(current_value)
+        comparison_display = format_value(comparison_value)
 
         # Determine color and arrow
         if change_pct > 0:
@@ -341,406 +574,472 @@ if not df.empty:
             color = "gray"
             arrow = "→"
 
+        sparkline = render_sparkline(trend) if trend is not None else ""
+        extra_lines = "".join(
+            f'<p style="margin: 0; color: #555; font-size: 0.85em;">'
+            f'vs {extra_label}: {change_against(extra_value):+.1f}% ({format_value(extra_value)})</p>'
+            for extra_label, extra_value in (extra_comparisons or [])
+        )
+
         st.markdown(f"""
         <div style="background-color: #f0f2f6; padding: 15px; border-radius: 10px; margin: 5px 0;">
             <h4 style="margin: 0; color: #1f1f1f;">{label}</h4>
             <h2 style="margin: 5px 0; color: #1f1f1f;">{current_display}</h2>
             <p style="margin: 0; color: {color}; font-weight: bold;">
                 {arrow} {change_pct:+.1f}% ({comparison_display})
-            </p>
+            </p>{extra_lines}{sparkline}
         </div>
         """, unsafe_allow_html=True)
 
-    # PAGE 1: OVERVIEW
-    if page == "Overview":
-        # Sidebar Filters for Overview
-        st.sidebar.title("Filters")
-
-        # Date Range
-        min_date = df["Date"].min()
-        max_date = df["Date"].max()
-        start_date, end_date = st.sidebar.date_input("Select date range", [min_date, max_date], min_value=min_date,
-                                                     max_value=max_date)
+    # Section queries run on pandas unless the [analytics] secrets select another backend, e.g.
+    # backend = "duckdb" to run them as DuckDB queries over a Parquet copy of the sessions, or
+    # backend = "partitioned" to load only the months of a month-partitioned store each query touches;
+    # a store_path that ingest_exports fills is read as it is and is then the page's only source
+    ANALYTICS_BACKEND = ANALYTICS_CONFIG.get("backend", "pandas")
+
+    @st.cache_resource(show_spinner=False, max_entries=2)
+    def load_backend(_df, data_version):
+        """Section query backend over the shared dataset"""
+        first_seen = None
+        dictionary = user_dictionary()
+        if dictionary is not None:
+            # Only the in-memory frame carries the codes; the stores look users up by ID. A view of some
+            # sites dates users by their first session on those sites
+            first_seen = dictionary.first_seen(by_code=ANALYTICS_BACKEND == "pandas", sites=VIEW_SITES)
+        elif "aggregate_store" in ANALYTICS_CONFIG:
+            first_seen = load_aggregate_store(_df, data_version).first_seen()
+        return core.make_backend(_df, ANALYTICS_BACKEND,
+                                 scoped_path(ANALYTICS_CONFIG.get("parquet_path", "data/sessions.parquet")),
+                                 scoped_path(ANALYTICS_CONFIG.get("store_path", "data/sessions")), first_seen)
+
+    # Section results are cached on the data version and the filter state, so a section is computed
+    # the first time it is opened for a given selection and reused afterwards
+    @st.cache_data(show_spinner=False, max_entries=32)
+    def compute_window_kpis(_df, data_version, countries, devices, windows):
+        """KPIs of every comparison window for the selected countries and devices"""
+        return load_backend(_df, data_version).window_kpis(countries, devices, windows)
+
+    @st.cache_data(show_spinner=False, max_entries=64)
+    def compute_sessions_by(_df, data_version, key, start_date, end_date, countries, devices):
+        """Session counts of the filtered rows grouped by a column, or by 'Weekday'"""
+        # With an aggregate store only the days of the range are read from it; otherwise the selected
+        # backend counts them, the pandas one from daily segment aggregates it builds once
+        if "aggregate_store" in ANALYTICS_CONFIG:
+            segments = load_aggregate_store(_df, data_version).segments(start_date, end_date)
+            return core.segment_sessions_by(segments, key, start_date, end_date, countries, devices)
+        return load_backend(_df, data_version).sessions_by(key, start_date, end_date, countries, devices)
+
+    @st.cache_data(show_spinner=False, max_entries=32)
+    def compute_country_breakdown(_df, data_version, start_date, end_date, countries, devices):
+        """Country breakdown table of the filtered rows"""
+        return load_backend(_df, data_version).country_breakdown(start_date, end_date, countries, devices)
+
+    @st.cache_data(show_spinner=False, max_entries=32)
+    def compute_top_referrers(_df, data_version, start_date, end_date, countries, devices, top_k=15):
+        """Top referrers of the filtered rows, summed from the per-day referrer counts for large selections"""
+        if ANALYTICS_BACKEND != "pandas":
+            # The other backends rank every selection from their own rows
+            return load_backend(_df, data_version).top_referrers(start_date, end_date, countries, devices, top_k)
+
+        filtered_df = filter_sessions(_df, start_date, end_date, countries, devices)
+        if len(filtered_df) <= EXACT_REFERRER_MAX_ROWS:
+            return core.exact_top_referrers(filtered_df, top_k)
+
+        # Large selections sum the shared per-day referrer counts
+        return merge_referrer_counts(build_referrer_counts(_df, data_version), start_date, end_date, countries,
+                                     devices, top_k)
+
+    @st.cache_data(show_spinner=False, max_entries=32)
+    def compute_top_users(_df, data_version, start_date, end_date, countries, devices):
+        """Top 10 users of the filtered rows by sessions"""
+        return load_backend(_df, data_version).top_users(start_date, end_date, countries, devices)
+
+    @st.cache_data(show_spinner=False, max_entries=32)
+    def compute_new_users(_df, data_version, start_date, end_date, countries, devices):
+        """Users first seen in the period, with their latest visit in the filtered rows"""
+        return load_backend(_df, data_version).new_users(start_date, end_date, countries, devices)
+
+    # Page sections. Each section is a fragment that receives the filter state it depends on as
+    # arguments, so interacting with a widget inside a section reruns only that section.
+    @st.fragment
+    @instrumented("section.kpi")
+    def render_kpi_section(start_date, end_date, selected_countries, selected_devices, comparison_type=None):
+        """KPI cards with the comparison controls that only they depend on"""
+        control_col1, control_col2, control_col3 = st.columns([2, 1, 2])
+
+        # Comparison Filter, unless it was already committed with the batched sidebar filters
+        if comparison_type is None:
+            comparison_type = control_col1.selectbox("Comparison Period", COMPARISON_TYPES, key="filter_comparison")
+
+        # Multi-period comparison: extra reference windows computed in the same pass as the KPIs
+        show_trend = control_col2.checkbox("Show KPI trend", value=False)
+        trailing_periods = 0
+        include_last_year = False
+        custom_range = None
+        if show_trend:
+            trailing_periods = control_col2.slider("Trailing periods", min_value=2, max_value=12, value=4)
+            include_last_year = control_col3.checkbox("Compare with same period last year", value=True)
+            custom_dates = control_col3.date_input("Custom comparison range", [], max_value=df["Date"].max())
+            if len(custom_dates) == 2:
+                custom_range = custom_dates
+
+        # Calculate KPIs for the current period and every comparison window together
+        windows = get_comparison_windows(start_date, end_date, comparison_type, trailing_periods,
+                                         include_last_year, custom_range)
+        window_kpis = compute_window_kpis(df, data_version, tuple(selected_countries), tuple(selected_devices),
+                                          windows)
+        current_kpis = window_kpis.loc["Current"]
+        comparison_kpis = window_kpis.loc["Comparison"]
+        comp_start_date, comp_end_date = windows[1][1], windows[1][2]
+
+        # Trend runs from the oldest trailing period up to the current one
+        trend_labels = [f"T-{i}" for i in range(trailing_periods, 0, -1)] + ["Current"]
+        extra_labels = [label for label in ["Last Year", "Custom"] if label in window_kpis.index]
+
+        def kpi_card(label, key, format_type="number"):
+            trend = window_kpis.loc[trend_labels, key].tolist() if show_trend else None
+            extras = [(extra_label, window_kpis.loc[extra_label, key]) for extra_label in extra_labels]
+            display_comparison_metric(label, current_kpis[key], comparison_kpis[key], format_type, trend, extras)
 
-        # Country Filter
-        all_countries = sorted(df["Country"].unique())
-        selected_countries = st.sidebar.multiselect("Select Country", all_countries, default=all_countries)
-
-        # Device Filter
-        all_devices = sorted(df["Device"].unique())
-        selected_devices = st.sidebar.multiselect("Select Device", all_devices, default=all_devices)
-
-        # Comparison Filter
-        comparison_type = st.sidebar.selectbox("Comparison Period", ["Last Trailing Period", "Same Period Last Month"])
-
-        # Apply Filters for current period
-        filtered_df = df.copy()
-        filtered_df = filtered_df[
-            (filtered_df["Date"] >= pd.to_datetime(start_date)) &
-            (filtered_df["Date"] <= pd.to_datetime(end_date)) &
-            (filtered_df["Country"].isin(selected_countries)) &
-            (filtered_df["Device"].isin(selected_devices))
-            ]
-
-        # Get comparison period dates and filter
-        comp_start_date, comp_end_date = get_comparison_dates(start_date, end_date, comparison_type)
-        comparison_df = df.copy()
-        comparison_df = comparison_df[
-            (comparison_df["Date"] >= comp_start_date) &
-            (comparison_df["Date"] <= comp_end_date) &
-            (comparison_df["Country"].isin(selected_countries)) &
-            (comparison_df["Device"].isin(selected_devices))
-            ]
-
-        # Calculate KPIs for both periods
-        current_kpis = calculate_kpis(filtered_df, df, start_date, end_date)
-        comparison_kpis = calculate_kpis(comparison_df, df, comp_start_date, comp_end_date)
-
-        # Layout
-        st.title("Gitforce Website Analytics - Overview")
-
-        # Display current date range
-        st.markdown(f"**Current Period:** {start_date} to {end_date}")
         st.markdown(
             f"**Comparison Period ({comparison_type}):** {comp_start_date.strftime('%Y-%m-%d')} to {comp_end_date.strftime('%Y-%m-%d')}")
-
-        st.markdown("---")
+        if show_trend:
+            st.caption(f"Trend lines cover the previous {trailing_periods} trailing periods and the current period.")
 
         # KPI Cards
         col1, col2, col3, col4 = st.columns(4)
 
         with col1:
-            display_comparison_metric("Unique Users", current_kpis['unique_users'], comparison_kpis['unique_users'])
+            kpi_card("Unique Users", 'unique_users')
 
         with col2:
-            display_comparison_metric("New Users", current_kpis['new_users'], comparison_kpis['new_users'])
+            kpi_card("New Users", 'new_users')
 
         with col3:
-            display_comparison_metric("Total Sessions", current_kpis['total_sessions'], comparison_kpis['total_sessions'])
+            kpi_card("Total Sessions", 'total_sessions')
 
         with col4:
-            display_comparison_metric("Returning Users", current_kpis['returning_users'],
-                                      comparison_kpis['returning_users'])
+            kpi_card("Returning Users", 'returning_users')
 
         col5, col6, col7 = st.columns(3)
 
         with col5:
-            display_comparison_metric("Avg Session Duration", current_kpis['avg_duration'], comparison_kpis['avg_duration'],
-                                      "duration")
+            kpi_card("Avg Session Duration", 'avg_duration', "duration")
 
         with col6:
-            display_comparison_metric("Page Views", current_kpis['page_views'], comparison_kpis['page_views'])
+            kpi_card("Page Views", 'page_views')
 
         with col7:
-            display_comparison_metric("Bounce Rate", current_kpis['bounce_rate'], comparison_kpis['bounce_rate'],
-                                      "percentage")
-
-        st.markdown("---")
+            kpi_card("Bounce Rate", 'bounce_rate', "percentage")
 
-        # Additional Visualizations
-        st.markdown("## Detailed Analytics")
-
-        # Row 1: Device and OS Breakdown
+    @st.fragment
+    @instrumented("section.device_os")
+    def render_device_os_section(filter_state):
+        """Device and OS breakdown pies"""
         col1, col2 = st.columns(2)
 
         with col1:
             st.markdown("### Device Breakdown by Sessions")
-            if len(filtered_df) > 0:
-                device_sessions = filtered_df['Device'].value_counts().reset_index()
+            device_sessions = compute_sessions_by(df, data_version, 'Device', *filter_state)
+            if len(device_sessions) > 0:
+                device_sessions = device_sessions.sort_values(ascending=False).reset_index()
                 device_sessions.columns = ['Device', 'Sessions']
 
-                fig_device = px.pie(
-                    device_sessions,
-                    values='Sessions',
-                    names='Device',
-                    hole=0.4,
-                    color_discrete_sequence=px.colors.qualitative.Set3
-                )
-                fig_device.update_traces(textposition='inside', textinfo='percent+label')
-                fig_device.update_layout(
-                    showlegend=True,
-                    height=400,
-                    margin=dict(t=0, b=0, l=0, r=0)
-                )
+                fig_device = build_pie_figure(device_sessions, 'Sessions', 'Device', 'Set3')
                 st.plotly_chart(fig_device, use_container_width=True)
             else:
                 st.info("No data available for the selected filters.")
 
         with col2:
             st.markdown("### OS Breakdown by Sessions")
-            if len(filtered_df) > 0:
-                os_sessions = filtered_df['OS'].value_counts().reset_index()
+            os_sessions = compute_sessions_by(df, data_version, 'OS', *filter_state)
+            if len(os_sessions) > 0:
+                os_sessions = os_sessions.sort_values(ascending=False).reset_index()
                 os_sessions.columns = ['Operating System', 'Sessions']
 
-                fig_os = px.pie(
-                    os_sessions,
-                    values='Sessions',
-                    names='Operating System',
-                    hole=0.4,
-                    color_discrete_sequence=px.colors.qualitative.Pastel
-                )
-                fig_os.update_traces(textposition='inside', textinfo='percent+label')
-                fig_os.update_layout(
-                    showlegend=True,
-                    height=400,
-                    margin=dict(t=0, b=0, l=0, r=0)
-                )
+                fig_os = build_pie_figure(os_sessions, 'Sessions', 'Operating System', 'Pastel')
                 st.plotly_chart(fig_os, use_container_width=True)
             else:
                 st.info("No data available for the selected filters.")
 
-        # Row 2: Country Breakdown Table
+    @st.fragment
+    @instrumented("section.country")
+    def render_country_section(filter_state):
+        """Country breakdown table"""
         st.markdown("### Country Breakdown")
-        if len(filtered_df) > 0:
-            # Calculate country metrics
-            country_metrics = []
+        country_df = compute_country_breakdown(df, data_version, *filter_state)
+        if len(country_df) > 0:
+            # Display the table
+            render_table(country_df, {
+                "Country": st.column_config.TextColumn("Country", width="medium"),
+                "Total Unique Users": st.column_config.NumberColumn("Total Unique Users", format="%d"),
+                "New Users": st.column_config.NumberColumn("New Users", format="%d"),
+                "Sessions": st.column_config.NumberColumn("Sessions", format="%d"),
+                "Time Spent": st.column_config.TextColumn("Time Spent", width="medium")
+            })
+            render_downloads(f"country_breakdown_{filter_state[0]}_{filter_state[1]}", lambda: iter_chunks(country_df))
+        else:
+            st.info("No data available for the selected filters.")
 
-            for country in filtered_df['Country'].unique():
-                country_data = filtered_df[filtered_df['Country'] == country]
+    @st.fragment
+    @instrumented("section.percentile")
+    def render_percentile_section(filter_state):
+        """Session duration and page count percentiles, with their own segment selector"""
+        st.markdown("### Session Duration & Page Count Percentiles")
+        sketches = build_quantile_sketches(df, data_version)
+        overall = query_sketch_quantiles(sketches, *filter_state)
+        if len(overall) > 0:
+            percentile_cols = st.columns(6)
+            for col, quantile_name in zip(percentile_cols[:3], ['p50', 'p90', 'p99']):
+                col.metric(f"Duration {quantile_name}",
+                           format_duration(round(overall.loc[0, f'duration_{quantile_name}'])))
+            for col, quantile_name in zip(percentile_cols[3:], ['p50', 'p90', 'p99']):
+                col.metric(f"Pages {quantile_name}", f"{overall.loc[0, f'pages_{quantile_name}']:.0f}")
+
+            # Wide ranges merge the sketches per week or month, then every trace is capped with LTTB
+            granularity = choose_time_granularity(filter_state[0], filter_state[1])
+            period_percentiles = query_sketch_quantiles(sketches, *filter_state, by='Date', granularity=granularity)
+            chart_data = downsample_time_series(period_percentiles, 'Date',
+                                                ['duration_p50', 'duration_p90', 'duration_p99'])
+            fig_percentiles = build_line_figure(chart_data, 'Date', 'Value',
+                                                f'{granularity} Session Duration Percentiles (seconds)', "Date",
+                                                "Session Duration (seconds)", markers=False, legend_title="Percentile",
+                                                color='Series')
+            st.plotly_chart(fig_percentiles, use_container_width=True)
+
+            percentile_segment = st.radio("Percentiles by", ["Country", "Device"], horizontal=True)
+            segment_percentiles = query_sketch_quantiles(sketches, *filter_state, by=percentile_segment)
+            for quantile_name in ['p50', 'p90', 'p99']:
+                segment_percentiles[f'duration_{quantile_name}'] = format_durations(
+                    segment_percentiles[f'duration_{quantile_name}'].round())
+                segment_percentiles[f'pages_{quantile_name}'] = segment_percentiles[f'pages_{quantile_name}'].round()
+
+            render_table(segment_percentiles, {
+                percentile_segment: st.column_config.TextColumn(percentile_segment, width="medium"),
+                "duration_p50": st.column_config.TextColumn("Duration p50"),
+                "duration_p90": st.column_config.TextColumn("Duration p90"),
+                "duration_p99": st.column_config.TextColumn("Duration p99"),
+                "pages_p50": st.column_config.NumberColumn("Pages p50", format="%d"),
+                "pages_p90": st.column_config.NumberColumn("Pages p90", format="%d"),
+                "pages_p99": st.column_config.NumberColumn("Pages p99", format="%d")
+            })
+            st.caption(f"Percentiles are estimated from pre-built sketches and are accurate to within "
+                       f"{SKETCH_RELATIVE_ACCURACY:.0%}.")
+        else:
+            st.info("No data available for the selected filters.")
 
-                # Calculate metrics for this country
-                country_kpis = calculate_kpis(country_data, df, start_date, end_date)
+    @st.fragment
+    @instrumented("section.referrer")
+    def render_referrer_section(filter_state):
+        """Top referrers bar chart"""
+        st.markdown("### Top Referrers by Sessions")
+        top_referrers = compute_top_referrers(df, data_version, *filter_state)
+        if len(top_referrers) > 0:
+            # Create horizontal bar chart (sorted ascending for better visual display)
+            chart_data = top_referrers.sort_values('Sessions', ascending=True).reset_index(drop=True)
+            fig_referrers = build_referrer_figure(chart_data)
+            st.plotly_chart(fig_referrers, use_container_width=True)
+        else:
+            st.info("No data available for the selected filters.")
 
-                country_metrics.append({
-                    'Country': country,
-                    'Total Unique Users': country_kpis['unique_users'],
-                    'New Users': country_kpis['new_users'],
-                    'Sessions': country_kpis['total_sessions'],
-                    'Time Spent': format_duration(country_data['TotalSeconds'].sum())
-                })
+    @st.fragment
+    @instrumented("section.top_users")
+    def render_top_users_section(filter_state):
+        """Top 10 users table"""
+        st.markdown("###  Top 10 Users")
+
+        user_metrics = compute_top_users(df, data_version, *filter_state)
+
+        render_table(user_metrics, {
+            "Clarity User ID": st.column_config.TextColumn("Clarity User ID", width="medium"),
+            "Country": st.column_config.TextColumn("Country", width="small"),
+            "Device": st.column_config.TextColumn("Device", width="small"),
+            "Referrer": st.column_config.TextColumn("Referrer", width="medium"),
+            "Sessions": st.column_config.NumberColumn("Sessions", format="%d"),
+            "Session Clicks": st.column_config.NumberColumn("Session Clicks", format="%d"),
+            "Page Views": st.column_config.NumberColumn("Page Views", format="%d"),
+            "Time Spent": st.column_config.TextColumn("Time Spent", width="small")
+        })
+        render_downloads(f"top_users_{filter_state[0]}_{filter_state[1]}", lambda: iter_chunks(user_metrics))
+
+    @st.fragment
+    @instrumented("section.new_users")
+    def render_new_users_section(filter_state):
+        """New users table"""
+        st.markdown("### New Users")
 
-            # Convert to DataFrame and sort by sessions
-            country_df = pd.DataFrame(country_metrics)
-            country_df = country_df.sort_values('Sessions', ascending=False)
+        new_user_metrics = compute_new_users(df, data_version, *filter_state)
 
-            # Display the table
-            st.dataframe(
-                country_df,
-                use_container_width=True,
-                hide_index=True,
-                column_config={
-                    "Country": st.column_config.TextColumn("Country", width="medium"),
-                    "Total Unique Users": st.column_config.NumberColumn("Total Unique Users", format="%d"),
-                    "New Users": st.column_config.NumberColumn("New Users", format="%d"),
-                    "Sessions": st.column_config.NumberColumn("Sessions", format="%d"),
-                    "Time Spent": st.column_config.TextColumn("Time Spent", width="medium")
-                }
+        if len(new_user_metrics) > 0:
+            render_table(new_user_metrics, {
+                "Clarity User ID": st.column_config.TextColumn("Clarity User ID", width="medium"),
+                "Country": st.column_config.TextColumn("Country", width="small"),
+                "Device": st.column_config.TextColumn("Device", width="small"),
+                "Referrer": st.column_config.TextColumn("Referrer", width="medium"),
+                "Latest Visit Date": st.column_config.DateColumn("Latest Visit Date"),
+                "Time Spent": st.column_config.TextColumn("Time Spent", width="small")
+            })
+            render_downloads(f"new_users_{filter_state[0]}_{filter_state[1]}", lambda: iter_chunks(new_user_metrics))
+        else:
+            st.info("No new users found in the selected period.")
+
+    @st.fragment
+    @instrumented("section.cohort")
+    def render_cohort_section(filter_state):
+        """Cohort retention heatmap, with its own granularity selector"""
+        st.markdown("### Cohort Retention")
+
+        start_date, end_date, selected_countries, selected_devices = filter_state
+        cohort_granularity = st.radio("Cohort granularity", ["Weekly", "Monthly"], horizontal=True)
+        retention = compute_cohort_retention(df, data_version, cohort_granularity, selected_countries,
+                                             selected_devices, start_date, end_date)
+
+        if len(retention) > 0:
+            retention_pct = retention.drop(columns="Cohort Size")
+            retention_pct.columns = [f"+{offset}" for offset in retention_pct.columns]
+            cohort_labels = [f"{cohort} ({size:,})" for cohort, size in retention["Cohort Size"].items()]
+
+            fig_cohort = build_cohort_figure(
+                retention_pct, cohort_labels,
+                f"{'Weeks' if cohort_granularity == 'Weekly' else 'Months'} since first visit"
             )
+
+            st.plotly_chart(fig_cohort, use_container_width=True)
         else:
-            st.info("No data available for the selected filters.")
+            st.info("No cohorts acquired in the selected period.")
 
+    @st.fragment
+    @instrumented("section.daily_sessions")
+    def render_daily_sessions_section(filter_state):
+        """Daily session count chart"""
+        st.markdown("###  Unique User Sessions Over Time")
 
-        # Row 3: Top Referrers (IMPROVED VERSION)
-        st.markdown("### Top Referrers by Sessions")
-        if len(filtered_df) > 0:
-            # Get referrer session counts
-            referrer_sessions = filtered_df['Referrer'].value_counts().reset_index()
-            referrer_sessions.columns = ['Referrer', 'Sessions']
-            
-            # Sort by sessions in descending order to get top referrers
-            referrer_sessions = referrer_sessions.sort_values('Sessions', ascending=False)
-
-            # Show top 15 referrers (or all if fewer than 15)
-            max_referrers = min(15, len(referrer_sessions))
-            top_referrers = referrer_sessions.head(max_referrers)
-
-            if len(top_referrers) > 0:
-                # Create horizontal bar chart (sorted ascending for better visual display)
-                chart_data = top_referrers.sort_values('Sessions', ascending=True)
-                
-                fig_referrers = px.bar(
-                    chart_data,
-                    x='Sessions',
-                    y='Referrer',
-                    orientation='h',
-                    color='Sessions',
-                    color_continuous_scale='viridis',
-                    text='Sessions',
-                    title=f'Top {len(top_referrers)} Referrers by Session Count'
-                )
-
-                # Update layout for better readability
-                fig_referrers.update_traces(
-                    textposition='outside',
-                    texttemplate='%{text}',
-                    hovertemplate='<b>%{y}</b><br>Sessions: %{x}<extra></extra>'
-                )
-                
-                fig_referrers.update_layout(
-                    height=max(500, len(top_referrers) * 35),  # Dynamic height
-                    showlegend=False,
-                    xaxis_title="Number of Sessions",
-                    yaxis_title="Referrer Source",
-                    coloraxis_showscale=False,
-                    margin=dict(l=200, r=100, t=80, b=50),  # Adjusted margins
-                    font=dict(size=12),
-                    title_x=0.5,  # Center the title
-                    yaxis=dict(
-                        tickmode='linear',
-                        automargin=True
-                    )
-                )
-
-                st.plotly_chart(fig_referrers, use_container_width=True)
+        # Wide ranges switch to weekly or monthly buckets, and the series is capped with LTTB
+        granularity = choose_time_granularity(filter_state[0], filter_state[1])
+        daily_sessions = compute_sessions_by(df, data_version, 'Date', *filter_state)
+        period_sessions = daily_sessions.groupby(period_start(daily_sessions.index, granularity)).sum()
+        period_sessions = period_sessions.rename_axis('Date').reset_index(name='Total Sessions')
 
+        keep = lttb_indices(period_sessions['Date'].values.astype("int64"), period_sessions['Total Sessions'].values,
+                            MAX_CHART_POINTS)
+        chart_data = period_sessions.iloc[keep].reset_index(drop=True)
 
+        fig_time = build_line_figure(chart_data, 'Date', 'Total Sessions', f'{granularity} Session Count', "Date",
+                                     "Total Sessions", markers=len(chart_data) <= 120)
 
+        st.plotly_chart(fig_time, use_container_width=True)
+        if len(chart_data) < len(period_sessions):
+            st.caption(f"Showing {len(chart_data)} of {len(period_sessions)} points, downsampled to preserve peaks.")
 
+    @st.fragment
+    @instrumented("section.weekday")
+    def render_weekday_section(filter_state):
+        """Sessions by weekday chart"""
+        st.markdown("### Unique User Sessions by Weekday")
 
-    # PAGE 2: USER INSIGHTS
-    elif page == "User Insights":
-        # Apply Filters for User Insights
-        filtered_df = df.copy()
-        filtered_df = filtered_df[
-            (filtered_df["Date"] >= pd.to_datetime(start_date)) &
-            (filtered_df["Date"] <= pd.to_datetime(end_date)) &
-            (filtered_df["Country"].isin(selected_countries)) &
-            (filtered_df["Device"].isin(selected_devices))
-            ]
+        # Define weekday order
+        weekday_order = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
 
-        st.title("Gitforce Website Analytics - User Insights")
+        weekday_sessions = compute_sessions_by(df, data_version, 'Weekday', *filter_state).reset_index(
+            name='Total Sessions')
+        weekday_sessions['Weekday'] = pd.Categorical(weekday_sessions['Weekday'], categories=weekday_order,
+                                                     ordered=True)
+        weekday_sessions = weekday_sessions.sort_values('Weekday')
 
-        # Display current date range
-        st.markdown(f"**Period:** {start_date} to {end_date}")
-        st.markdown("---")
+        fig_weekday = build_line_figure(weekday_sessions, 'Weekday', 'Total Sessions', 'Sessions by Weekday',
+                                        "Weekday", "Total Sessions")
 
-        if len(filtered_df) > 0:
-            # 1. Top 10 Users Table
-            st.markdown("###  Top 10 Users")
+        st.plotly_chart(fig_weekday, use_container_width=True)
 
-        # Calculate user metrics
-        user_metrics = filtered_df.groupby('Clarity user ID').agg({
-            'Country': 'first',
-            'Device': 'first',
-            'Referrer': 'first',
-            'Date': 'count',  # Sessions count
-            'Session clicks': 'sum',  # Total clicks
-            'Page count': 'sum'  # Total page views
-        }).reset_index()
+    # PAGE 1: OVERVIEW
+    if page == "Overview":
+        filter_state = (start_date, end_date, tuple(selected_countries), tuple(selected_devices))
 
-        user_metrics.columns = ['Clarity User ID', 'Country', 'Device', 'Referrer', 'Sessions', 'Session Clicks',
-                                'Page Views']
-        user_metrics = user_metrics.sort_values('Sessions', ascending=False).head(10)
+        # Display current date range
+        st.markdown(f"**Current Period:** {start_date} to {end_date}")
 
-        st.dataframe(
-            user_metrics,
-            use_container_width=True,
-            hide_index=True,
-            column_config={
-                "Clarity User ID": st.column_config.TextColumn("Clarity User ID", width="medium"),
-                "Country": st.column_config.TextColumn("Country", width="small"),
-                "Device": st.column_config.TextColumn("Device", width="small"),
-                "Referrer": st.column_config.TextColumn("Referrer", width="medium"),
-                "Sessions": st.column_config.NumberColumn("Sessions", format="%d"),
-                "Session clicks": st.column_config.NumberColumn("Session clicks", format="%d"),
-                "Page Views": st.column_config.NumberColumn("Page Views", format="%d")
-            }
-        )
+        render_kpi_section(start_date, end_date, selected_countries, selected_devices, comparison_type)
 
         st.markdown("---")
 
-        # 2. New Users Table
-        st.markdown("### New Users")
-
-        # Find new users (first appearance in the filtered period)
-        first_seen_dates = df.groupby("Clarity user ID")["Date"].min().reset_index(name="first_seen")
-        new_users_in_period = first_seen_dates[
-            (first_seen_dates["first_seen"] >= pd.to_datetime(start_date)) &
-            (first_seen_dates["first_seen"] <= pd.to_datetime(end_date))
-            ]
-
-        # Get new users data from filtered dataframe
-        new_users_data = filtered_df[
-            filtered_df["Clarity user ID"].isin(new_users_in_period["Clarity user ID"])
-        ]
-
-        if len(new_users_data) > 0:
-            # Get latest visit date for each new user
-            new_user_metrics = new_users_data.groupby('Clarity user ID').agg({
-                'Country': 'first',
-                'Device': 'first',
-                'Referrer': 'first',
-                'Date': 'max'  # Latest date
-            }).reset_index()
-
-            new_user_metrics.columns = ['Clarity User ID', 'Country', 'Device', 'Referrer', 'Latest Visit Date']
-            new_user_metrics = new_user_metrics.sort_values('Latest Visit Date', ascending=False)
-
-            st.dataframe(
-                new_user_metrics,
-                use_container_width=True,
-                hide_index=True,
-                column_config={
-                    "Clarity User ID": st.column_config.TextColumn("Clarity User ID", width="medium"),
-                    "Country": st.column_config.TextColumn("Country", width="small"),
-                    "Device": st.column_config.TextColumn("Device", width="small"),
-                    "Referrer": st.column_config.TextColumn("Referrer", width="medium"),
-                    "Latest Visit Date": st.column_config.DateColumn("Latest Visit Date")
-                }
-            )
-        else:
-            st.info("No new users found in the selected period.")
+        # Additional Visualizations
+        st.markdown("## Detailed Analytics")
 
-        st.markdown("---")
+        # Only the open tab is computed; results are cached once computed
+        device_tab, country_tab, percentile_tab, referrer_tab = st.tabs(
+            ["Devices & OS", "Countries", "Percentiles", "Referrers"], key="overview_tab", on_change="rerun")
 
-        # 3. Unique User Sessions Over Time
-        st.markdown("###  Unique User Sessions Over Time")
+        with device_tab:
+            if device_tab.open:
+                render_device_os_section(filter_state)
 
-        daily_sessions = filtered_df.groupby('Date').size().reset_index(name='Total Sessions')
+        with country_tab:
+            if country_tab.open:
+                render_country_section(filter_state)
 
-        fig_time = px.line(
-            daily_sessions,
-            x='Date',
-            y='Total Sessions',
-            title='Daily Session Count',
-            markers=True
-        )
+        with percentile_tab:
+            if percentile_tab.open:
+                render_percentile_section(filter_state)
 
-        fig_time.update_layout(
-            height=400,
-            xaxis_title="Date",
-            yaxis_title="Total Sessions",
-            hovermode='x unified'
-        )
+        with referrer_tab:
+            if referrer_tab.open:
+                render_referrer_section(filter_state)
 
-        st.plotly_chart(fig_time, use_container_width=True)
+    # PAGE 2: USER INSIGHTS
+    elif page == "User Insights":
+        filter_state = (start_date, end_date, tuple(selected_countries), tuple(selected_devices))
 
+        # Display current date range
+        st.markdown(f"**Period:** {start_date} to {end_date}")
         st.markdown("---")
 
-        # 4. Unique User Sessions Over Weekdays
-        st.markdown("### Unique User Sessions by Weekday")
+        # Counted from a row mask, without computing any section or copying the rows
+        if len(filtered_positions(df, *filter_state)) > 0:
+            # Only the open tab is computed; results are cached once computed
+            top_users_tab, new_users_tab, cohort_tab, daily_tab, weekday_tab = st.tabs(
+                ["Top Users", "New Users", "Cohort Retention", "Sessions Over Time", "Sessions by Weekday"],
+                key="user_insights_tab", on_change="rerun")
 
-        # Add weekday column
-        filtered_df_weekday = filtered_df.copy()
-        filtered_df_weekday['Weekday'] = filtered_df_weekday['Date'].dt.day_name()
+            with top_users_tab:
+                if top_users_tab.open:
+                    render_top_users_section(filter_state)
 
-        # Define weekday order
-        weekday_order = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+            with new_users_tab:
+                if new_users_tab.open:
+                    render_new_users_section(filter_state)
 
-        weekday_sessions = filtered_df_weekday.groupby('Weekday').size().reset_index(name='Total Sessions')
-        weekday_sessions['Weekday'] = pd.Categorical(weekday_sessions['Weekday'], categories=weekday_order,
-                                                     ordered=True)
-        weekday_sessions = weekday_sessions.sort_values('Weekday')
+            with cohort_tab:
+                if cohort_tab.open:
+                    render_cohort_section(filter_state)
 
-        fig_weekday = px.line(
-            weekday_sessions,
-            x='Weekday',
-            y='Total Sessions',
-            title='Sessions by Weekday',
-            markers=True
-        )
+            with daily_tab:
+                if daily_tab.open:
+                    render_daily_sessions_section(filter_state)
 
-        fig_weekday.update_layout(
-            height=400,
-            xaxis_title="Weekday",
-            yaxis_title="Total Sessions",
-            hovermode='x unified'
-        )
+            with weekday_tab:
+                if weekday_tab.open:
+                    render_weekday_section(filter_state)
 
-        st.plotly_chart(fig_weekday, use_container_width=True)
+        else:
+            st.info("No data available for the selected filters.")
 
-    else:
-        st.info("No data available for the selected filters.")
+    # Hidden performance panel: per-stage timings of this server process, shown with ?debug=1
+    if DEBUG_MODE:
+        with st.sidebar.expander("Performance"):
+            stage_summary = instrumentation.stage_summary()
+            if len(stage_summary) > 0:
+                st.markdown("**Stages (p50/p95 over recent runs)**")
+                st.dataframe(stage_summary, hide_index=True, use_container_width=True,
+                             column_config={
+                                 "p50 (s)": st.column_config.NumberColumn(format="%.3f"),
+                                 "p95 (s)": st.column_config.NumberColumn(format="%.3f"),
+                                 "Last memory delta (MB)": st.column_config.NumberColumn(format="%.1f")
+                             })
+                st.markdown("**Recent spans**")
+                st.dataframe(instrumentation.recent_spans()[['stage', 'rows', 'seconds', 'memory_delta_mb']],
+                             hide_index=True, use_container_width=True)
+            else:
+                st.caption("No stages recorded yet.")
 
 
 
@@ -0,0 +1,119 @@
+"""Synthetic Clarity "Downloaded data" exports for benchmarks and offline runs
+
+The generated tables look like the raw sheet rows the dashboard loads: dayfirst date strings,
+power-law user activity, referrer URLs, mm:ss / hh:mm:ss durations and a sprinkling of missing
+or malformed values. The same seed always produces the same table.
+
+Example:
+    python synthetic_data.py --rows 100000 --output sessions.csv
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+COUNTRIES = ["India", "United States", "United Kingdom", "Germany", "France", "Canada", "Australia", "Brazil",
+             "Japan", "Singapore", "Netherlands", "Kenya", "Nigeria", "Spain", "Italy", "Mexico"]
+DEVICES = ["PC", "Mobile", "Tablet"]
+OPERATING_SYSTEMS = ["Windows", "Android", "iOS", "MacOSX", "Linux", "ChromeOS"]
+REFERRERS = [
+    "https://www.google.com/", "https://www.google.co.in/search?q=gitforce", "https://www.bing.com/search?q=git",
+    "https://duckduckgo.com/", "https://www.linkedin.com/feed/", "https://t.co/x1y2z3", "https://github.com/",
+    "https://www.facebook.com/", "https://news.ycombinator.com/item?id=1", "https://www.reddit.com/r/git/",
+    "android-app://com.google.android.gm/", "chatgpt.com", "http://localhost:3000/"
+]
+
+# Share of rows with a missing or malformed value in each column
+MISSING_RATES = {
+    "Date": 0.002,
+    "Clarity user ID": 0.003,
+    "Device": 0.01,
+    "Country": 0.01,
+    "OS": 0.02,
+    "Session duration": 0.05
+}
+
+
+def _skewed_choice(rng, options, size, skew=1.2):
+    """Pick options with a Zipf-like preference for the first ones"""
+    weights = 1 / np.arange(1, len(options) + 1) ** skew
+    return rng.choice(len(options), size=size, p=weights / weights.sum())
+
+
+def _format_durations(seconds):
+    """mm:ss strings, hh:mm:ss from an hour on, formatted once per distinct value"""
+    codes, unique_seconds = pd.factorize(seconds)
+    formatted = np.array([
+        f"{value // 3600}:{value % 3600 // 60:02d}:{value % 60:02d}" if value >= 3600
+        else f"{value // 60:02d}:{value % 60:02d}"
+        for value in unique_seconds
+    ], dtype=object)
+    return formatted[codes]
+
+
+def generate_clarity_export(rows, seed=0, start_date="2024-01-01", days=365, users=None):
+    """Raw Clarity export rows as the sheet returns them, all columns as strings or ints
+
+    users defaults to a quarter of the rows; a few heavy users account for a large share of the
+    sessions while the long tail visits only a handful of times.
+    """
+    rng = np.random.default_rng(seed)
+    users = users or max(10, rows // 4)
+
+    # Dates: a weekly rhythm plus growth over the period, formatted dayfirst like the sheet
+    day_weights = (1 + 0.3 * (np.arange(days) % 7 < 5)) * np.linspace(1, 2, days)
+    day_offsets = rng.choice(days, size=rows, p=day_weights / day_weights.sum())
+    day_labels = (pd.Timestamp(start_date) + pd.to_timedelta(np.arange(days), unit="D")).strftime("%d/%m/%Y")
+    dates = np.asarray(day_labels, dtype=object)[day_offsets]
+
+    # Users: a power law, so a small head of returning users holds much of the traffic
+    user_index = (users * rng.random(rows) ** 3).astype("int64")
+    user_ids = np.array([np.base_repr(value, 36).lower() for value in rng.permutation(users) + 36 ** 5],
+                        dtype=object)[user_index]
+
+    # Durations: heavy tailed, capped at four hours
+    seconds = np.minimum((rng.pareto(1.3, size=rows) * 20).astype("int64"), 4 * 3600)
+
+    # Referrers: mostly direct or search, with empty and null-like spellings of "direct"
+    referrer_options = np.array(["", "None", "null"] + REFERRERS +
+                                [f"https://www.site{i}.com/blog/post-{i}?utm_source=x" for i in range(200)],
+                                dtype=object)
+    referrers = referrer_options[_skewed_choice(rng, referrer_options, rows, skew=0.9)]
+
+    page_counts = np.minimum(rng.geometric(0.55, size=rows), 60)
+    table = pd.DataFrame({
+        "Date": dates,
+        "Clarity user ID": user_ids,
+        "Device": np.array(DEVICES, dtype=object)[_skewed_choice(rng, DEVICES, rows)],
+        "Country": np.array(COUNTRIES, dtype=object)[_skewed_choice(rng, COUNTRIES, rows)],
+        "OS": np.array(OPERATING_SYSTEMS, dtype=object)[_skewed_choice(rng, OPERATING_SYSTEMS, rows)],
+        "Referrer": referrers,
+        "Page count": page_counts,
+        "Session clicks": rng.poisson(page_counts * 2.5),
+        "Session duration": _format_durations(seconds)
+    })
+
+    # Missing and malformed values, as found in real exports
+    for column, rate in MISSING_RATES.items():
+        missing = rng.random(rows) < rate
+        table.loc[missing, column] = "not a date" if column == "Date" else None
+    return table
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write a synthetic Clarity 'Downloaded data' export.")
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--days", type=int, default=365)
+    parser.add_argument("--output", required=True, help="CSV or Parquet file to write")
+    args = parser.parse_args(argv)
+
+    table = generate_clarity_export(args.rows, seed=args.seed, days=args.days)
+    if args.output.endswith(".parquet"):
+        table.to_parquet(args.output, index=False)
+    else:
+        table.to_csv(args.output, index=False)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""Persistent, append-only dictionary of every user ever seen, with compact integer codes
+
+Each "Clarity user ID" gets the next integer code the first time it appears and keeps it for good,
+together with the date of its first session. Rows are never removed and first-seen dates only move
+earlier, so when old rows are trimmed from the sheet to stay under its size limits, users whose
+early sessions were dropped still count as returning rather than new. The codes let the analytics
+index users by integer instead of by string ID. First-seen dates are also kept per site, so a user
+who first came through another site is still new in a view of the sites they came to later.
+"""
+import os
+import sqlite3
+import threading
+from contextlib import closing
+
+import numpy as np
+import pandas as pd
+
+from analytics_core import USER_CODE
+from instrumentation import instrumented
+
+SCHEMA = """
+-- user_id has no declared type, so numeric IDs from the sheet keep their type
+CREATE TABLE IF NOT EXISTS users (
+    code INTEGER PRIMARY KEY,
+    user_id UNIQUE NOT NULL,
+    first_seen TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS site_first_seen (
+    site TEXT NOT NULL,
+    code INTEGER NOT NULL REFERENCES users (code),
+    first_seen TEXT NOT NULL,
+    PRIMARY KEY (site, code)
+);
+"""
+
+# Site of the dates of dictionaries written before they were kept per site; it counts for every site
+ANY_SITE = ""
+
+
+class UserDictionary:
+    """User ID to code and first-seen date mapping kept in a SQLite file and mirrored in memory"""
+
+    def __init__(self, path):
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Codes are assigned densely from 0, so a code is also a position in the in-memory arrays
+        self.user_ids = pd.Index([], dtype=object, name="Clarity user ID")
+        self.first_seen_dates = np.empty(0, dtype="datetime64[ns]")
+        self._lock = threading.Lock()
+        with closing(self.connect()) as connection, connection:
+            connection.executescript(SCHEMA)
+            connection.execute("""
+                INSERT INTO site_first_seen (site, code, first_seen) SELECT ?, code, first_seen FROM users
+                WHERE NOT EXISTS (SELECT 1 FROM site_first_seen)
+            """, [ANY_SITE])
+            self._sync(connection)
+
+    def connect(self):
+        """A new connection; each operation uses its own so sessions on different threads never share one"""
+        return sqlite3.connect(self.path)
+
+    def _sync(self, connection):
+        """Pick up the users another process added since this dictionary last read the file"""
+        users = pd.read_sql_query("SELECT code, user_id, first_seen FROM users WHERE code >= ? ORDER BY code",
+                                  connection, params=[len(self.user_ids)])
+        if len(users):
+            self.user_ids = self.user_ids.append(pd.Index(users['user_id'].tolist(), dtype=object,
+                                                               name="Clarity user ID"))
+            self.first_seen_dates = np.concatenate([self.first_seen_dates,
+                                                    pd.to_datetime(users['first_seen']).to_numpy("datetime64[ns]")])
+
+    @instrumented("user_dictionary.update")
+    def update(self, df):
+        """Add the users of the preprocessed sessions and move first-seen dates earlier, returning the new users"""
+        first_seen = df.groupby("Clarity user ID")["Date"].min()
+        site_first_seen = df.groupby(["Site", "Clarity user ID"], observed=True)["Date"].min().reset_index()
+        with self._lock, closing(self.connect()) as connection, connection:
+            # Taking the write lock first keeps codes unique when several processes share the file
+            connection.execute("BEGIN IMMEDIATE")
+            self._sync(connection)
+
+            codes = self.user_ids.get_indexer(first_seen.index)
+            dates = first_seen.to_numpy("datetime64[ns]")
+            is_new = codes == -1
+            earlier = ~is_new
+            earlier[earlier] = dates[earlier] < self.first_seen_dates[codes[earlier]]
+
+            days = first_seen.dt.strftime("%Y-%m-%d").to_numpy()
+            new_codes = np.arange(len(self.user_ids), len(self.user_ids) + is_new.sum())
+            connection.executemany("INSERT INTO users (code, user_id, first_seen) VALUES (?, ?, ?)",
+                                   zip(new_codes.tolist(), first_seen.index[is_new].tolist(), days[is_new].tolist()))
+            connection.executemany("UPDATE users SET first_seen = min(first_seen, ?) WHERE code = ?",
+                                   zip(days[earlier].tolist(), codes[earlier].tolist()))
+
+            first_seen_dates = self.first_seen_dates.copy()
+            first_seen_dates[codes[earlier]] = dates[earlier]
+            self.first_seen_dates = np.concatenate([first_seen_dates, dates[is_new]])
+            self.user_ids = self.user_ids.append(pd.Index(first_seen.index[is_new].tolist(), dtype=object,
+                                                           name="Clarity user ID"))
+
+            connection.executemany("""
+                INSERT INTO site_first_seen (site, code, first_seen) VALUES (?, ?, ?)
+                ON CONFLICT (site, code) DO UPDATE SET first_seen = min(first_seen, excluded.first_seen)
+            """, zip(site_first_seen["Site"].astype(str).tolist(),
+                     self.user_ids.get_indexer(site_first_seen["Clarity user ID"]).tolist(),
+                     site_first_seen["Date"].dt.strftime("%Y-%m-%d").tolist()))
+        return int(is_new.sum())
+
+    def encode(self, user_ids):
+        """int32 codes of user IDs, -1 for any the dictionary has not seen"""
+        return self.user_ids.get_indexer(user_ids).astype("int32")
+
+    def first_seen(self, by_code=False, sites=None):
+        """First session date of every user ever seen, indexed by user ID, or by code for frames carrying codes
+
+        With sites, the first session on any of those sites of every user seen on them.
+        """
+        if sites is None:
+            index = pd.RangeIndex(len(self.user_ids), name=USER_CODE) if by_code else self.user_ids
+            return pd.Series(self.first_seen_dates, index=index, name="Date")
+
+        sites = [ANY_SITE, *map(str, sites)]
+        with self._lock, closing(self.connect()) as connection:
+            self._sync(connection)
+            first_seen = pd.read_sql_query(f"""
+                SELECT code, min(first_seen) AS first_seen FROM site_first_seen
+                WHERE site IN ({", ".join("?" * len(sites))}) GROUP BY code ORDER BY code
+            """, connection, params=sites)
+        codes = first_seen['code'].to_numpy()
+        index = pd.Index(codes, name=USER_CODE) if by_code else self.user_ids[codes]
+        return pd.Series(pd.to_datetime(first_seen['first_seen']).to_numpy("datetime64[ns]"), index=index,
+                         name="Date")